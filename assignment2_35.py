@@ -2,6 +2,11 @@ import os
 import pyspark.sql.functions as F
 import pyspark.sql.types as T
 from utilities import SEED
+from utilities import aggregate_fragments
+from utilities import ColumnImputer
+from utilities import Moments
+from utilities import SortedLookup
+from utilities import lookup_list_stats
 import pandas as pd
 # import any other dependencies you want, but make sure only to use the ones
 # availiable on AWS EMR
@@ -48,11 +53,30 @@ def task_1(data_io, review_data, product_data):
 
     # ---------------------- Your implementation begins------------------------
 
-    # join product and review data on asin (product id)
-    joined = product_data.select('asin').join(review_data, on='asin', how='left')
-    
-    # groupby asin (product id)
-    grouped = joined.groupby(joined['asin']).agg({'reviewerID': 'count', 'overall': 'avg'})
+    # dictionary-encoded inputs carry an int32 asin_id instead of asin
+    key = 'asin_id' if 'asin_id' in product_data.columns else asin_column
+
+    def ratings():
+        # per-asin review counts and rating sums, built once and reused
+        rollup = data_io.review_rollup(review_data, key)
+
+        # join product data with the rollup on asin (product id); asin is
+        # unique in product, so there is no skew to profile
+        joined = data_io.join(product_data.select(key), rollup, key, how='left',
+                              label='review_rollup', unique_left=True)
+
+        # groupby asin (product id); count is 0 and avg null without reviews
+        return joined.groupby(joined[key]).agg(
+            F.coalesce(F.sum('count'), F.lit(0)).alias(count_rating_column),
+            (F.sum('sum_overall') / F.sum('count_overall')).alias(mean_rating_column)
+        )
+
+    grouped = data_io.materialize('task_1_ratings_' + key, ratings, ['product', 'review'])
+    grouped = grouped.select(
+        grouped[key],
+        grouped[count_rating_column].alias('count(reviewerID)'),
+        grouped[mean_rating_column].alias('avg(overall)')
+    )
     
     # with and without null values for later calculations
     with_null = grouped.fillna('').fillna(0)
@@ -105,7 +129,7 @@ def task_1(data_io, review_data, product_data):
     # -------------------------------------------------------------------------
 
 
-def task_2(data_io, product_data):
+def task_2_plan(data_io, product_data):
     # -----------------------------Column names--------------------------------
     # Inputs:
     salesRank_column = 'salesRank'
@@ -119,49 +143,89 @@ def task_2(data_io, product_data):
 
     # ---------------------- Your implementation begins------------------------
 
-    product_data_flattened = product_data.select(
-        product_data[asin_column],
-        product_data.categories[0][0].alias(category_column),
-        F.explode_outer(product_data.salesRank)
-    ).withColumnRenamed('key', bestSalesCategory_column).withColumnRenamed('value', bestSalesRank_column)
-
-    product_data_flattened = product_data_flattened.select(
-        [F.when(F.col(c)=='', None).otherwise(F.col(c)).alias(c) for c in product_data_flattened.columns]
-    )
-
-    a1 = product_data_flattened.agg(
-        F.count(product_data_flattened[asin_column]),
-        F.avg(product_data_flattened[bestSalesRank_column]),
-        F.variance(product_data_flattened[bestSalesRank_column]),
-        F.count(product_data_flattened[category_column]),
-        F.countDistinct(product_data_flattened[category_column]),
-        F.count(product_data_flattened[bestSalesCategory_column]),
-        F.countDistinct(product_data_flattened[bestSalesCategory_column])
-    ).toPandas()
+    def flatten():
+        product_data_flattened = product_data.select(
+            product_data[asin_column],
+            product_data.categories[0][0].alias(category_column),
+            F.explode_outer(product_data.salesRank)
+        ).withColumnRenamed('key', bestSalesCategory_column).withColumnRenamed('value', bestSalesRank_column)
+
+        return product_data_flattened.select(
+            [F.when(F.col(c)=='', None).otherwise(F.col(c)).alias(c) for c in product_data_flattened.columns]
+        )
+
+    # the statistics of the flattened table (one row per salesRank entry,
+    # one for a row without any, '' read as null), aggregated per product row
+    # so they come out of the same scan as the other product tasks
+    sales_rank = product_data[salesRank_column]
+    asin = product_data[asin_column]
+    category = product_data[categories_column][0][0]
+    rows = F.greatest(F.size(sales_rank), F.lit(1))
+    ranks_sql = f'filter(map_values(`{salesRank_column}`), x -> x IS NOT NULL)'
+    ranks = F.expr(ranks_sql)
+    # exact integer sums, so the variance does not cancel
+    rank_sum = F.expr(
+        f'aggregate({ranks_sql}, CAST(0 AS DECIMAL(38,0)), '
+        '(acc, x) -> CAST(acc + x AS DECIMAL(38,0)))')
+    rank_sumsq = F.expr(
+        f'aggregate({ranks_sql}, CAST(0 AS DECIMAL(38,0)), '
+        '(acc, x) -> CAST(acc + CAST(x AS DECIMAL(38,0)) * CAST(x AS DECIMAL(38,0)) AS DECIMAL(38,0)))')
+    sales_categories = F.expr(f"filter(map_keys(`{salesRank_column}`), k -> k != '')")
+
+    fragments = [(product_data, [
+        F.sum(F.when(asin.isNotNull() & (asin != ''), rows).otherwise(0)).alias('count_asin'),
+        F.sum(F.when(ranks.isNotNull(), F.size(ranks)).otherwise(0)).alias('count_rank'),
+        F.sum(rank_sum).alias('sum_rank'),
+        F.sum(rank_sumsq).alias('sumsq_rank'),
+        F.sum(F.when(category.isNotNull() & (category != ''), rows).otherwise(0)).alias('count_category'),
+        F.size(F.collect_set(F.when(category != '', category))).alias('distinct_category'),
+        F.sum(F.when(sales_rank.isNotNull(), F.size(sales_categories)).otherwise(0)).alias('count_bestSalesCategory'),
+        F.expr(f"size(array_remove(array_distinct(flatten(collect_set(map_keys(`{salesRank_column}`)))), ''))").alias('distinct_bestSalesCategory')
+    ])]
 
     # -------------------------------------------------------------------------
 
-    # ---------------------- Put results in res dict --------------------------
-    res = {
-        'count_total': None,
-        'mean_bestSalesRank': None,
-        'variance_bestSalesRank': None,
-        'numNulls_category': None,
-        'countDistinct_category': None,
-        'numNulls_bestSalesCategory': None,
-        'countDistinct_bestSalesCategory': None
-    }
-    # Modify res:
+    def finalize(values):
+        a1 = values[0]
+        # a few dozen sales categories, so one partition each; only written
+        # with a materialize_root
+        data_io.materialize(
+            'task_2_bestSalesCategory', flatten, ['product'],
+            partition_by=[bestSalesCategory_column]
+        )
+        n = int(a1['count_rank'] or 0)
+        total = int(a1['sum_rank'] or 0)
+        squares = int(a1['sumsq_rank'] or 0)
+
+        # ---------------------- Put results in res dict ----------------------
+        res = {
+            'count_total': None,
+            'mean_bestSalesRank': None,
+            'variance_bestSalesRank': None,
+            'numNulls_category': None,
+            'countDistinct_category': None,
+            'numNulls_bestSalesCategory': None,
+            'countDistinct_bestSalesCategory': None
+        }
+        # Modify res:
+
+        res['count_total'] = int(a1['count_asin'])
+        res['mean_bestSalesRank'] = int(total / n)
+        res['variance_bestSalesRank'] = float((squares * n - total * total) / (n * (n - 1)))
+        res['numNulls_category'] = res['count_total'] - int(a1['count_category'])
+        res['countDistinct_category'] = int(a1['distinct_category'])
+        res['numNulls_bestSalesCategory'] = res['count_total'] - int(a1['count_bestSalesCategory'])
+        res['countDistinct_bestSalesCategory'] = int(a1['distinct_bestSalesCategory'])
+
+        # ---------------------------------------------------------------------
+        return res
+
+    return fragments, finalize
 
-    res['count_total'] = int(a1[f'count({asin_column})'].iloc[0])
-    res['mean_bestSalesRank'] = int(a1[f'avg({bestSalesRank_column})'].iloc[0])
-    res['variance_bestSalesRank'] = float(a1[f'var_samp({bestSalesRank_column})'].iloc[0])
-    res['numNulls_category'] = res['count_total'] - int(a1[f'count({category_column})'].iloc[0])
-    res['countDistinct_category'] = int(a1[f'count(DISTINCT {category_column})'].iloc[0])
-    res['numNulls_bestSalesCategory'] = res['count_total'] - int(a1[f'count({bestSalesCategory_column})'].iloc[0])
-    res['countDistinct_bestSalesCategory'] = int(a1[f'count(DISTINCT {bestSalesCategory_column})'].iloc[0])
 
-    # -------------------------------------------------------------------------
+def task_2(data_io, product_data):
+    fragments, finalize = task_2_plan(data_io, product_data)
+    res = finalize(aggregate_fragments(fragments))
 
     # ----------------------------- Do not change -----------------------------
     data_io.save(res, 'task_2')
@@ -169,7 +233,7 @@ def task_2(data_io, product_data):
     # -------------------------------------------------------------------------
 
 
-def task_3(data_io, product_data):
+def task_3_plan(data_io, product_data):
     # -----------------------------Column names--------------------------------
     # Inputs:
     asin_column = 'asin'
@@ -183,73 +247,93 @@ def task_3(data_io, product_data):
 
     # ---------------------- Your implementation begins------------------------
 
-    # create alias for later use in self-join
-    product_data_a = product_data.alias('product_data_a')
-    
-    # expand also_viwed array into multiple rows
-    product_data_a = product_data_a.select(
-        product_data_a[asin_column],
-        F.explode_outer(product_data_a[related_column][attribute])
-    ).withColumnRenamed('col', attribute)
-    
-    # create alias for later use in self-join
-    product_data_b = product_data.alias('product_data_b')
-    
-    # select just asin and price
-    product_data_b = product_data_b.select(
-        product_data_b[asin_column],
-        product_data_b[price_column]
-    ).withColumnRenamed(asin_column, attribute)
-    
-    # join expanded table with price table
-    product_data_flattened = product_data_a.join(product_data_b, on=attribute, how='left')
-    
-    aggregated = product_data_flattened.groupby(product_data_flattened[asin_column]).agg(
-        F.count(product_data_flattened[attribute]),
-        F.avg(product_data_flattened[price_column])
-    )
-    
-    # turn count == 0 into null
-    aggregated = aggregated.select(
-        aggregated[asin_column],
-        aggregated[f'avg({price_column})'],
-        F.when(F.col(f'count({attribute})')==0, None).otherwise(F.col(f'count({attribute})')).alias(f'count({attribute})')
-    )
-    
-    # final aggregations
-    a1 = aggregated.agg(
-        F.count(aggregated[asin_column]),
-        F.mean(aggregated[f'avg({price_column})']),
-        F.variance(aggregated[f'avg({price_column})']),
-        F.count(aggregated[f'avg({price_column})']),
-        F.mean(aggregated[f'count({attribute})']),
-        F.variance(aggregated[f'count({attribute})']),
-        F.count(aggregated[f'count({attribute})'])
-    ).toPandas()
+    # the asin -> price pairs for the lookup come out of the product scan the
+    # other product tasks aggregate in; the also_viewed expansion needs the
+    # lookup, so it runs once they are collected. Null prices are kept: an
+    # asin's rows all join, priced or not
+    fragments = [(product_data, [
+        F.collect_list(F.when(
+            product_data[asin_column].isNotNull(),
+            F.struct(product_data[asin_column], product_data[price_column].cast('double').alias(price_column))
+        )).alias('prices')
+    ])]
+
+    def aggregate(prices):
+        # expand also_viewed and average the prices where each product row
+        # lives, so the exploded edges are never shuffled
+        aggregated = lookup_list_stats(
+            product_data, asin_column, product_data[related_column][attribute], prices,
+            count_column=countAlsoViewed_column, mean_column=meanPriceAlsoViewed_column
+        )
+
+        # turn count == 0 into null
+        return aggregated.select(
+            aggregated[asin_column],
+            aggregated[meanPriceAlsoViewed_column],
+            F.when(F.col(countAlsoViewed_column)==0, None).otherwise(F.col(countAlsoViewed_column)).alias(countAlsoViewed_column)
+        )
+
+    def statistics(prices):
+        aggregated = data_io.materialize('task_3_alsoViewed', lambda: aggregate(prices), ['product'])
+        aggregated = aggregated.select(
+            aggregated[asin_column],
+            aggregated[meanPriceAlsoViewed_column].alias(f'avg({price_column})'),
+            aggregated[countAlsoViewed_column].alias(f'count({attribute})')
+        )
+
+        # final aggregations
+        return aggregate_fragments([(aggregated, [
+            F.count(aggregated[asin_column]),
+            F.mean(aggregated[f'avg({price_column})']),
+            F.variance(aggregated[f'avg({price_column})']),
+            F.count(aggregated[f'avg({price_column})']),
+            F.mean(aggregated[f'count({attribute})']),
+            F.variance(aggregated[f'count({attribute})']),
+            F.count(aggregated[f'count({attribute})'])
+        ])])[0]
 
     # -------------------------------------------------------------------------
 
-    # ---------------------- Put results in res dict --------------------------
-    res = {
-        'count_total': None,
-        'mean_meanPriceAlsoViewed': None,
-        'variance_meanPriceAlsoViewed': None,
-        'numNulls_meanPriceAlsoViewed': None,
-        'mean_countAlsoViewed': None,
-        'variance_countAlsoViewed': None,
-        'numNulls_countAlsoViewed': None
-    }
-    # Modify res:
+    def finalize(values):
+        # compact asin -> (rows, price sum, price count) table, what the
+        # join against the product rows would contribute; broadcast to every
+        # executor and dropped from them once the statistics are collected
+        prices = SortedLookup.from_records(values[0]['prices'], asin_column, price_column)
+        prices = data_io.spark.sparkContext.broadcast(prices)
+        try:
+            a1 = statistics(prices)
+        finally:
+            prices.unpersist()
+
+        # ---------------------- Put results in res dict ----------------------
+        res = {
+            'count_total': None,
+            'mean_meanPriceAlsoViewed': None,
+            'variance_meanPriceAlsoViewed': None,
+            'numNulls_meanPriceAlsoViewed': None,
+            'mean_countAlsoViewed': None,
+            'variance_countAlsoViewed': None,
+            'numNulls_countAlsoViewed': None
+        }
+        # Modify res:
+
+        res['count_total'] = int(a1[f'count({asin_column})'])
+        res['mean_meanPriceAlsoViewed'] = float(a1[f'avg(avg({price_column}))'])
+        res['variance_meanPriceAlsoViewed'] = float(a1[f'var_samp(avg({price_column}))'])
+        res['numNulls_meanPriceAlsoViewed'] = res['count_total'] - int(a1[f'count(avg({price_column}))'])
+        res['mean_countAlsoViewed'] = float(a1[f'avg(count({attribute}))'])
+        res['variance_countAlsoViewed'] = float(a1[f'var_samp(count({attribute}))'])
+        res['numNulls_countAlsoViewed'] = res['count_total'] - int(a1[f'count(count({attribute}))'])
+
+        # ---------------------------------------------------------------------
+        return res
+
+    return fragments, finalize
 
-    res['count_total'] = int(a1[f'count({asin_column})'].iloc[0])
-    res['mean_meanPriceAlsoViewed'] = float(a1[f'avg(avg({price_column}))'].iloc[0])
-    res['variance_meanPriceAlsoViewed'] = float(a1[f'var_samp(avg({price_column}))'].iloc[0])
-    res['numNulls_meanPriceAlsoViewed'] = res['count_total'] - int(a1[f'count(avg({price_column}))'].iloc[0])
-    res['mean_countAlsoViewed'] = float(a1[f'avg(count({attribute}))'].iloc[0])
-    res['variance_countAlsoViewed'] = float(a1[f'var_samp(count({attribute}))'].iloc[0])
-    res['numNulls_countAlsoViewed'] = res['count_total'] - int(a1[f'count(count({attribute}))'].iloc[0])
 
-    # -------------------------------------------------------------------------
+def task_3(data_io, product_data):
+    fragments, finalize = task_3_plan(data_io, product_data)
+    res = finalize(aggregate_fragments(fragments))
 
     # ----------------------------- Do not change -----------------------------
     data_io.save(res, 'task_3')
@@ -257,7 +341,7 @@ def task_3(data_io, product_data):
     # -------------------------------------------------------------------------
 
 
-def task_4(data_io, product_data):
+def task_4_plan(data_io, product_data):
     # -----------------------------Column names--------------------------------
     # Inputs:
     price_column = 'price'
@@ -270,58 +354,85 @@ def task_4(data_io, product_data):
 
     # ---------------------- Your implementation begins------------------------
 
-    aggregated = product_data.select(product_data[price_column]).dropna().summary('mean', '50%').toPandas()
-    
-    imputed = product_data.select(
-        product_data['asin'],
-        product_data[price_column].alias(meanImputedPrice_column),
-        product_data[price_column].alias(medianImputedPrice_column),
-        product_data[title_column].alias(unknownImputedTitle_column)
-    )
-    
-    imputed = imputed.fillna({
-        meanImputedPrice_column: aggregated[aggregated['summary'] == 'mean']['price'].iloc[0],
-        medianImputedPrice_column: aggregated[aggregated['summary'] == '50%']['price'].iloc[0],
-        unknownImputedTitle_column: 'unknown'
+    # the median is exact
+    imputer = ColumnImputer({
+        meanImputedPrice_column: (price_column, 'mean'),
+        medianImputedPrice_column: (price_column, 'median')
     })
-    
-    a1 = imputed.agg(
-        F.count(imputed['asin']),
-        F.avg(imputed[meanImputedPrice_column]),
-        F.variance(imputed[meanImputedPrice_column]),
-        F.count(imputed[meanImputedPrice_column]),
-        F.avg(imputed[medianImputedPrice_column]),
-        F.variance(imputed[medianImputedPrice_column]),
-        F.count(imputed[medianImputedPrice_column]),
-    ).toPandas()
-    
-    a2 = imputed.select(unknownImputedTitle_column).where(imputed[unknownImputedTitle_column] == 'unknown').count()
+
+    def impute():
+        return imputer.transform(product_data).select(
+            product_data['asin'],
+            F.col(meanImputedPrice_column),
+            F.col(medianImputedPrice_column),
+            F.coalesce(product_data[title_column], F.lit('unknown')).alias(unknownImputedTitle_column)
+        )
+
+    # the fill values and the moments of the prices they fill in come out of
+    # one aggregation, so the imputed columns are never scanned
+    price = product_data[price_column]
+    fragments = [(product_data, imputer.aggregates() + [
+        F.count(F.lit(1)).alias('rows'),
+        F.count(product_data['asin']).alias('count_asin'),
+        F.count(price).alias('count_price'),
+        F.avg(price).alias('mean_price'),
+        F.variance(price).alias('variance_price'),
+        F.count(F.when(F.coalesce(product_data[title_column], F.lit('unknown')) == 'unknown', True)).alias('numUnknowns')
+    ])]
 
     # -------------------------------------------------------------------------
 
-    # ---------------------- Put results in res dict --------------------------
-    res = {
-        'count_total': None,
-        'mean_meanImputedPrice': None,
-        'variance_meanImputedPrice': None,
-        'numNulls_meanImputedPrice': None,
-        'mean_medianImputedPrice': None,
-        'variance_medianImputedPrice': None,
-        'numNulls_medianImputedPrice': None,
-        'numUnknowns_unknownImputedTitle': None
-    }
-    # Modify res:
+    def finalize(values):
+        a1 = values[0]
+        imputer.fit_values(a1)
+        # the per-row output is only written with a materialize_root
+        data_io.materialize('task_4_imputed', impute, ['product'])
+
+        # the known prices, then as many copies of the fill as there are nulls
+        n = int(a1['rows'])
+        known = int(a1['count_price'])
+        prices = Moments(known, a1['mean_price'] or 0.0, (known - 1) * a1['variance_price'] if known > 1 else 0.0)
+
+        def imputed(output):
+            fill = imputer.fills[output]
+            if fill is None:
+                return Moments()
+            return Moments(prices.n, prices.mean, prices.m2).merge(Moments(n - known, fill, 0.0))
+
+        mean_imputed = imputed(meanImputedPrice_column)
+        median_imputed = imputed(medianImputedPrice_column)
+
+        # ---------------------- Put results in res dict ----------------------
+        res = {
+            'count_total': None,
+            'mean_meanImputedPrice': None,
+            'variance_meanImputedPrice': None,
+            'numNulls_meanImputedPrice': None,
+            'mean_medianImputedPrice': None,
+            'variance_medianImputedPrice': None,
+            'numNulls_medianImputedPrice': None,
+            'numUnknowns_unknownImputedTitle': None
+        }
+        # Modify res:
+
+        res['count_total'] = int(a1['count_asin'])
+        res['mean_meanImputedPrice'] = float(mean_imputed.mean)
+        res['variance_meanImputedPrice'] = float(mean_imputed.variance())
+        res['numNulls_meanImputedPrice'] = res['count_total'] - mean_imputed.n
+        res['mean_medianImputedPrice'] = float(median_imputed.mean)
+        res['variance_medianImputedPrice'] = float(median_imputed.variance())
+        res['numNulls_medianImputedPrice'] = res['count_total'] - median_imputed.n
+        res['numUnknowns_unknownImputedTitle'] = int(a1['numUnknowns'])
+
+        # ---------------------------------------------------------------------
+        return res
+
+    return fragments, finalize
 
-    res['count_total'] = int(a1['count(asin)'].iloc[0])
-    res['mean_meanImputedPrice'] = float(a1[f'avg({meanImputedPrice_column})'].iloc[0])
-    res['variance_meanImputedPrice'] = float(a1[f'var_samp({meanImputedPrice_column})'].iloc[0])
-    res['numNulls_meanImputedPrice'] = res['count_total'] - int(a1[f'count({meanImputedPrice_column})'].iloc[0])
-    res['mean_medianImputedPrice'] = float(a1[f'avg({medianImputedPrice_column})'].iloc[0])
-    res['variance_medianImputedPrice'] = float(a1[f'var_samp({medianImputedPrice_column})'].iloc[0])
-    res['numNulls_medianImputedPrice'] = res['count_total'] - int(a1[f'count({medianImputedPrice_column})'].iloc[0])
-    res['numUnknowns_unknownImputedTitle'] = int(a2)
 
-    # -------------------------------------------------------------------------
+def task_4(data_io, product_data):
+    fragments, finalize = task_4_plan(data_io, product_data)
+    res = finalize(aggregate_fragments(fragments))
 
     # ----------------------------- Do not change -----------------------------
     data_io.save(res, 'task_4')
@@ -390,23 +501,27 @@ def task_6(data_io, product_processed_data):
 
     # ---------------------- Your implementation begins------------------------
 
-    stringIndexer = M.feature.StringIndexer(inputCol = category_column, outputCol = categoryIndex_column)
-    
-    model = stringIndexer.fit(product_processed_data)
-    
-    product_processed_data_output = model.transform(product_processed_data)
-    
-    ohe = M.feature.OneHotEncoderEstimator(inputCols = [categoryIndex_column], outputCols = [categoryOneHot_column], dropLast = False)
-    
-    model = ohe.fit(product_processed_data_output)
-    
-    product_processed_data_output = model.transform(product_processed_data_output)
-    
-    pca = M.feature.PCA(k=15, inputCol = categoryOneHot_column, outputCol = categoryPCA_column)
-    
-    model = pca.fit(product_processed_data_output)
-    
-    product_processed_data_output = model.transform(product_processed_data_output)
+    def transform():
+        stringIndexer = M.feature.StringIndexer(inputCol = category_column, outputCol = categoryIndex_column)
+
+        model = stringIndexer.fit(product_processed_data)
+
+        product_processed_data_output = model.transform(product_processed_data)
+
+        ohe = M.feature.OneHotEncoderEstimator(inputCols = [categoryIndex_column], outputCols = [categoryOneHot_column], dropLast = False)
+
+        model = ohe.fit(product_processed_data_output)
+
+        product_processed_data_output = model.transform(product_processed_data_output)
+
+        pca = M.feature.PCA(k=15, inputCol = categoryOneHot_column, outputCol = categoryPCA_column)
+
+        model = pca.fit(product_processed_data_output)
+
+        return model.transform(product_processed_data_output)
+
+    product_processed_data_output = data_io.materialize(
+        'task_6_categoryPCA', transform, ['product_processed'])
     
     a = product_processed_data_output.agg(
         F.count(product_processed_data_output['asin']),
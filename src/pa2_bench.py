@@ -0,0 +1,191 @@
+import importlib
+import os
+import sys
+import json
+import time
+import getpass
+import statistics
+from pyspark import RDD
+from pyspark.sql import DataFrame
+from utilities import PA2Data
+from utilities import spark_config
+from utilities import TASK_NAMES
+from pa2_main import PA2Executor
+from pa2_main import get_main_parser
+
+
+def distribution(values):
+    """Summary statistics of a list of run times."""
+    ordered = sorted(values)
+    return {
+        'runs': len(values),
+        'min': ordered[0],
+        'median': statistics.median(ordered),
+        'mean': statistics.mean(ordered),
+        'p90': ordered[min(int(0.9 * len(ordered)), len(ordered) - 1)],
+        'max': ordered[-1],
+        'stdev': statistics.stdev(ordered) if len(ordered) > 1 else 0.0
+    }
+
+
+class PA2Bench(object):
+    """Times tasks over repeated runs on one PA2Executor. Every task gets
+    args.warmup untimed runs, then args.repeats timed ones. Warm runs keep
+    every input of the benchmarked tasks cached across runs; cold runs drop
+    every cached table and derived input before each run and never read
+    materialized outputs (the OS page cache is left alone)."""
+    def __init__(self, args, task_imls):
+        self.args = args
+        self.pa2 = PA2Executor(args, task_imls, task_imls.INPUT_FORMAT,
+                               args.synonmys)
+        # runs are timed one by one, without memoized results
+        self.pa2.memo = None
+        if args.cold:
+            self.pa2.data_io.materialize_root = None
+        self.task_names = args.tasks or TASK_NAMES
+
+    def reset(self):
+        self.pa2.spark.catalog.clearCache()
+        self.pa2.data_io.release_derived()
+
+    def warm(self):
+        """Narrow every input of the benchmarked tasks to the columns they
+        read, cache it and count it once, so no timed run scans it."""
+        data_dict = self.pa2.data_dict
+        for name, columns in PA2Data.required_columns(
+                self.task_names).items():
+            data = data_dict[name]
+            if not isinstance(data, (DataFrame, RDD)):
+                continue
+            data_dict[name] = PA2Data.narrow(data, columns).cache()
+            data_dict[name].count()
+
+    def run_once(self, task_name):
+        if self.args.cold:
+            self.reset()
+        if self.pa2.metrics:
+            self.pa2.metrics.reset()
+        passed, seconds = self.pa2.eval_by_name(task_name)
+        metrics = {}
+        if self.pa2.metrics:
+            self.pa2.metrics.drain(self.pa2.spark.sparkContext)
+            metrics = self.pa2.task_metrics(task_name)
+        return passed, seconds, metrics
+
+    def run(self):
+        if not self.args.cold:
+            self.warm()
+        report = {}
+        for task_name in self.task_names:
+            for i in range(self.args.warmup):
+                self.run_once(task_name)
+            runs = [self.run_once(task_name)
+                    for i in range(self.args.repeats)]
+            times = [seconds for _, seconds, _ in runs]
+            report[task_name] = {
+                'passed': [passed for passed, _, _ in runs],
+                'time_sec': distribution(times),
+                'times': times,
+                'metrics': [metrics for _, _, metrics in runs]
+            }
+            print ("{}: median {:.3f} sec over {} runs".format(
+                task_name, report[task_name]['time_sec']['median'],
+                len(times)))
+        return report
+
+    def config(self):
+        return {
+            'spark_config': spark_config(self.pa2.spark),
+            'repeats': self.args.repeats,
+            'warmup': self.args.warmup,
+            'cold': self.args.cold,
+            'module_name': self.args.module_name,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'spark_version': self.pa2.spark.version
+        }
+
+
+def compare(report, baseline, threshold):
+    """Per-task change of the median time against the baseline report;
+    a task regressed if it is more than threshold (a fraction) slower."""
+    comparison = {}
+    for task_name, entry in report.items():
+        if task_name not in baseline:
+            continue
+        before = baseline[task_name]['time_sec']['median']
+        after = entry['time_sec']['median']
+        change = (after - before) / before if before else 0.0
+        comparison[task_name] = {
+            'baseline_median': before,
+            'median': after,
+            'change': change,
+            'regressed': change > threshold
+        }
+        print ("{}: {:.3f} -> {:.3f} sec ({:+.1%}){}".format(
+            task_name, before, after, change,
+            ' REGRESSION' if change > threshold else ''))
+    return comparison
+
+
+def get_bench_parser():
+    parser = get_main_parser()
+    parser.set_defaults(profile='benchmark')
+    parser.add_argument(
+        '--tasks', nargs='+', type=str, default=None,
+        help='tasks to benchmark (default: all)'
+    )
+    parser.add_argument(
+        '--repeats', type=int, default=5
+    )
+    parser.add_argument(
+        '--warmup', type=int, default=1
+    )
+    parser.add_argument(
+        '--cold', action='store_true',
+        help='drop cached inputs before every run'
+    )
+    parser.add_argument(
+        '--skip_tests', action='store_true',
+        help='do not check task results against the test results'
+    )
+    parser.add_argument(
+        '--bench_output', type=str, default=None,
+        help='JSON report path (default: <output_root>/bench.json)'
+    )
+    parser.add_argument(
+        '--baseline', type=str, default=None,
+        help='earlier JSON report to compare median times against'
+    )
+    parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help='relative slowdown of a median that counts as a regression'
+    )
+    return parser
+
+
+if __name__ == "__main__":
+
+    parser = get_bench_parser()
+    args = parser.parse_args()
+    username = getpass.getuser()
+    if not args.output_root:
+        args.output_root = '/home/{}/{}-pa2/test_results'.format(
+            username, args.pid)
+    task_imls = importlib.import_module(args.module_name)
+    bench = PA2Bench(args, task_imls)
+    output = {'config': bench.config(), 'tasks': bench.run()}
+    bench.pa2.data_io.flush()
+    regressed = False
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        output['baseline'] = args.baseline
+        output['comparison'] = compare(
+            output['tasks'], baseline['tasks'], args.threshold)
+        regressed = any(c['regressed'] for c in output['comparison'].values())
+    path = args.bench_output or os.path.join(args.output_root, 'bench.json')
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(output, f, indent=1)
+    print ("Benchmark report written to {}".format(path))
+    sys.exit(1 if regressed else 0)
@@ -0,0 +1,260 @@
+import argparse
+import os
+import json
+import numpy as np
+import pyspark.sql.types as T
+from pyspark.ml.linalg import Vectors
+from pyspark.ml.linalg import VectorUDT
+from utilities import spark_init
+from utilities import SPARK_PROFILES
+from utilities import uri
+from utilities import PA2Data
+from utilities import SEED
+from utilities import data_cat
+
+
+# Rows of every table at scale factor 1; each scales linearly.
+BASE_ROWS = {
+    'product': 100000,
+    'review': 1000000,
+    'reviewer': 200000,
+    'ml_features_train': 100000,
+    'ml_features_test': 25000
+}
+# Themed title vocabularies. Titles mostly draw from their category's theme,
+# so piano, rice and laptop (the task_5 synonym words) and their neighbours
+# clear Word2Vec's minCount at any scale.
+THEMES = {
+    'Musical Instruments': [
+        'piano', 'keyboard', 'digital', 'grand', 'upright', 'bench', 'pedal',
+        'guitar', 'strings', 'tuner', 'stand', 'weighted', 'keys'],
+    'Grocery & Gourmet Food': [
+        'rice', 'organic', 'basmati', 'jasmine', 'brown', 'white', 'grain',
+        'long', 'cooker', 'noodles', 'sauce', 'pack', 'bag'],
+    'Electronics': [
+        'laptop', 'notebook', 'sleeve', 'charger', 'gaming', 'screen', 'case',
+        'battery', 'adapter', 'usb', 'wireless', 'inch', 'bag'],
+    'Books': [
+        'guide', 'edition', 'novel', 'history', 'cookbook', 'paperback',
+        'volume', 'stories', 'complete', 'illustrated', 'piano', 'rice'],
+    'Home & Kitchen': [
+        'set', 'steel', 'stainless', 'cooker', 'rice', 'pan', 'knife', 'glass',
+        'storage', 'bowl', 'kitchen', 'laptop', 'stand']
+}
+COMMON_WORDS = ['new', 'black', 'premium', 'with', 'for', 'and', 'pro',
+                'classic', 'mini', 'large', 'small', 'deluxe']
+CATEGORIES = list(THEMES)
+FEATURES = 10
+TABLE_IDS = {'product': 1, 'review': 2, 'ml_features_train': 3,
+             'ml_features_test': 4}
+
+
+def asin_of(index):
+    return 'B{:09d}'.format(index)
+
+
+def zipf_indices(rng, n, size, exponent):
+    """size draws from {0, ..., n-1}, index i with probability proportional
+    to (i + 1) ** -exponent (continuous inverse CDF; at exponent 1 the
+    density 1/x integrates to a log, so the ranks are n ** u)."""
+    u = rng.random(size)
+    a = 1.0 - exponent
+    if abs(a) < 1e-9:
+        ranks = float(n) ** u
+    else:
+        ranks = ((n ** a - 1.0) * u + 1.0) ** (1.0 / a)
+    return np.minimum(ranks.astype(np.int64) - 1, n - 1).clip(0)
+
+
+def partitions(rows, partition_rows):
+    return max(1, -(-rows // partition_rows))
+
+
+class PA2DataGen(object):
+    """Writes review, product and product_processed as CSV and the ml
+    features as Parquet, laid out like the data_cat inputs so PA2Data.load
+    reads them unchanged. Every partition draws from its own generator
+    seeded with (seed, table, partition), so a given seed, scale and
+    partition size always produce the same files.
+
+    Skew: review asins and reviewers are Zipfian, as are also_viewed
+    entries, and also_viewed list lengths are Pareto distributed."""
+    def __init__(self, spark, output_dir, scale=1.0, seed=SEED, zipf=1.2,
+                 partition_rows=200000):
+        self.spark = spark
+        self.output_dir = output_dir
+        self.seed = seed
+        self.zipf = zipf
+        self.partition_rows = partition_rows
+        self.rows = {name: max(1, int(rows * scale))
+                     for name, rows in BASE_ROWS.items()}
+
+    def path(self, filename):
+        return os.path.join(self.output_dir, os.path.basename(filename))
+
+    def generate(self, table, rows, build):
+        """RDD of rows rows, partition i built by build(rng, start, stop)."""
+        seed = self.seed
+        per_partition = self.partition_rows
+        n = partitions(rows, per_partition)
+
+        def run(i, _):
+            rng = np.random.default_rng([seed, TABLE_IDS[table], i])
+            start = i * per_partition
+            return build(rng, start, min(start + per_partition, rows))
+
+        return self.spark.sparkContext.parallelize(range(n), n) \
+            .mapPartitionsWithIndex(run)
+
+    def products(self):
+        n = self.rows['product']
+        exponent = self.zipf
+
+        def build(rng, start, stop):
+            for i in range(start, stop):
+                category = CATEGORIES[int(rng.integers(len(CATEGORIES)))]
+                theme = THEMES[category]
+                words = [theme[int(rng.integers(len(theme)))]
+                         if rng.random() < 0.75 else
+                         COMMON_WORDS[int(rng.integers(len(COMMON_WORDS)))]
+                         for _ in range(int(rng.integers(3, 9)))]
+                title = ' '.join(words).title() \
+                    if rng.random() > 0.05 else None
+                price = float(round(rng.lognormal(3.0, 1.0), 2)) \
+                    if rng.random() > 0.3 else None
+                sales_rank = json.dumps(
+                    {category: int(rng.integers(1, 2000000))}) \
+                    if rng.random() > 0.2 else None
+                categories = json.dumps([[category, words[0].title()]]) \
+                    if rng.random() > 0.1 else None
+                related = None
+                if rng.random() > 0.15:
+                    length = min(int(rng.pareto(1.2) * 4), 500)
+                    viewed = zipf_indices(rng, n, length, exponent)
+                    bought = zipf_indices(
+                        rng, n, int(rng.integers(0, 6)), exponent)
+                    related = json.dumps({
+                        'also_viewed': [asin_of(int(j)) for j in viewed],
+                        'also_bought': [asin_of(int(j)) for j in bought]})
+                yield (asin_of(i), sales_rank, categories, title, price,
+                       related, category)
+
+        schema = T.StructType(PA2Data.product_schema.fields + [
+            T.StructField('category', T.StringType())])
+        return self.spark.createDataFrame(
+            self.generate('product', n, build), schema)
+
+    def reviews(self):
+        n_products = self.rows['product']
+        n_reviewers = self.rows['reviewer']
+        exponent = self.zipf
+        ratings = np.array([1.0, 2.0, 3.0, 4.0, 5.0])
+        weights = np.array([0.06, 0.05, 0.09, 0.2, 0.6])
+
+        def build(rng, start, stop):
+            size = stop - start
+            asins = zipf_indices(rng, n_products, size, exponent)
+            reviewers = zipf_indices(rng, n_reviewers, size, exponent)
+            overall = rng.choice(ratings, size, p=weights)
+            for a, r, o in zip(asins, reviewers, overall):
+                yield ('A{:013d}'.format(int(r)), asin_of(int(a)), float(o))
+
+        return self.spark.createDataFrame(
+            self.generate('review', self.rows['review'], build),
+            PA2Data.review_schema)
+
+    def ml_features(self, table):
+        weights = np.random.default_rng([self.seed, 0]).normal(size=FEATURES)
+
+        def build(rng, start, stop):
+            for i in range(start, stop):
+                x = rng.normal(size=FEATURES)
+                y = 4.0 + 0.3 * float(x.dot(weights)) + rng.normal(0, 0.5)
+                yield (Vectors.dense(x.tolist()),
+                       float(min(max(y, 1.0), 5.0)))
+
+        schema = T.StructType([
+            T.StructField('features', VectorUDT()),
+            T.StructField('overall', T.DoubleType())
+        ])
+        return self.spark.createDataFrame(
+            self.generate(table, self.rows[table], build), schema)
+
+    def write_csv(self, data, filename):
+        print ("Writing {} ...".format(filename), end='')  # noqa
+        data.write.mode('overwrite').csv(
+            uri(self.path(filename)), header=True, escape='"', quote='"')
+        print ("Done")
+
+    def run(self):
+        products = self.products().cache()
+        self.write_csv(products.drop('category'), data_cat.product_filename)
+        self.write_csv(products.selectExpr(
+            'asin', 'lower(title) AS title', 'category'
+        ).where('title IS NOT NULL'), data_cat.product_processed_filename)
+        products.unpersist()
+        self.write_csv(self.reviews(), data_cat.review_filename)
+        for table, filename in [
+                ('ml_features_train', data_cat.ml_features_train_filename),
+                ('ml_features_test', data_cat.ml_features_test_filename)]:
+            print ("Writing {} ...".format(filename), end='')  # noqa
+            self.ml_features(table).write.mode('overwrite').parquet(
+                uri(self.path(filename)))
+            print ("Done")
+
+    def arguments(self):
+        """pa2_main.py options that point at the generated files."""
+        return ' '.join('--{} {}'.format(option, self.path(filename)) for
+                        option, filename in [
+            ('review_filename', data_cat.review_filename),
+            ('product_filename', data_cat.product_filename),
+            ('product_processed_filename',
+             data_cat.product_processed_filename),
+            ('ml_features_train_filename',
+             data_cat.ml_features_train_filename),
+            ('ml_features_test_filename',
+             data_cat.ml_features_test_filename)])
+
+
+def get_datagen_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--output_dir', type=str, required=True
+    )
+    parser.add_argument(
+        '--scale', type=float, default=1.0,
+        help='scale factor; 1 is {} products and {} reviews'.format(
+            BASE_ROWS['product'], BASE_ROWS['review'])
+    )
+    parser.add_argument(
+        '--seed', type=int, default=SEED
+    )
+    parser.add_argument(
+        '--zipf', type=float, default=1.2,
+        help='exponent of the asin and reviewer popularity'
+    )
+    parser.add_argument(
+        '--partition_rows', type=int, default=200000
+    )
+    parser.add_argument(
+        '--pid', type=str, default='pa2-datagen'
+    )
+    parser.add_argument(
+        '--master', type=str, default=None
+    )
+    parser.add_argument(
+        '--profile', type=str, default='local',
+        choices=sorted(SPARK_PROFILES)
+    )
+    return parser
+
+
+if __name__ == "__main__":
+
+    parser = get_datagen_parser()
+    args = parser.parse_args()
+    spark = spark_init(args.pid, args.master, profile=args.profile)
+    datagen = PA2DataGen(spark, os.path.abspath(args.output_dir), args.scale,
+                         args.seed, args.zipf, args.partition_rows)
+    datagen.run()
+    print ("Run pa2_main.py with {}".format(datagen.arguments()))
@@ -4,10 +4,29 @@ import traceback
 import importlib
 import os
 import getpass
+import threading
+import queue
+try:
+    from pyspark import InheritableThread as Thread
+except ImportError:
+    from threading import Thread
 from utilities import spark_init
+from utilities import pinned_threads
+from utilities import spark_config
+from utilities import SPARK_PROFILES
 from utilities import PA2Test
 from utilities import PA2Data
+from utilities import PersistencePlanner
+from utilities import Prefetcher
+from utilities import TaskMemo
+from utilities import TaskIntervals
+from utilities import TaskMetricsListener
+from utilities import PlanCapture
+from utilities import PlanHistory
 from utilities import TASK_NAMES
+from utilities import TASK_DEPENDS
+from utilities import TASK_INPUTS
+from utilities import aggregate_fragments
 from utilities import data_cat
 import databricks.koalas as ks
 
@@ -21,9 +40,6 @@ class PA2Executor(object):
         output_pid_folder=False
     ):
 
-        self.spark = spark_init(args.pid)
-        if input_format == 'koalas':
-            ks.set_option('compute.default_index_type', 'distributed')
         path_dict = {
             'review': args.review_filename,
             'product': args.product_filename,
@@ -31,36 +47,94 @@ class PA2Executor(object):
             'ml_features_train': args.ml_features_train_filename,
             'ml_features_test': args.ml_features_test_filename
             }
+        self.spark = spark_init(
+            args.pid, getattr(args, 'master', None),
+            profile=getattr(args, 'profile', 'cluster'),
+            path_dict=path_dict,
+            auto_tune=getattr(args, 'auto_tune', False))
+        if input_format == 'koalas':
+            ks.set_option('compute.default_index_type', 'distributed')
 
         self.task_imls = task_imls
-        self.tests = PA2Test(self.spark, args.test_results_root)
+        self.run_tests = not getattr(args, 'skip_tests', False)
+        self.tests = None
+        if self.run_tests:
+            self.tests = PA2Test(self.spark, args.test_results_root)
         if output_pid_folder:
             output_root = os.path.join(args.output_root, args.pid)
         else:
             output_root = args.output_root
-        self.data_io = PA2Data(self.spark, path_dict, output_root, 
-                               deploy=True, input_format=input_format)
+        self.data_io = PA2Data(
+            self.spark, path_dict, output_root, deploy=True,
+            input_format=input_format,
+            conversion_root=getattr(args, 'conversion_root', None),
+            encode_asin=getattr(args, 'encode_asin', False),
+            review_state_root=getattr(args, 'review_state_root', None),
+            buckets=getattr(args, 'buckets', None),
+            materialize_root=getattr(args, 'materialize_root', None))
 
         self.data_dict, self.count_dict = self.data_io.load_all(
-            input_format=input_format, no_cache=True)
+            input_format=input_format, no_cache=True, lazy=True)
         self.task_names = TASK_NAMES
         self.synonmys = synonmys
+        self.planner = None
+        self.prefetcher = None
+        self.prefetch = getattr(args, 'prefetch', True)
+        self.concurrency = getattr(args, 'concurrency', 1)
+        self.fuse = getattr(args, 'fuse', False)
+        self.test_lock = threading.Lock()
+        self.memo = None
+        if getattr(args, 'memo_root', None):
+            self.memo = TaskMemo(args.memo_root, args.memo_entries)
+        self.force = getattr(args, 'force', False)
+        # job groups are thread-local only on pinned threads; otherwise
+        # jobs are attributed by when they start
+        self.intervals = None
+        if not pinned_threads(self.spark.sparkContext):
+            self.intervals = TaskIntervals()
+        try:
+            self.metrics = TaskMetricsListener.install(
+                self.spark.sparkContext, self.intervals)
+        except Exception as e:
+            print ("Spark metrics are not collected: {}".format(e))
+            self.metrics = None
+        self.plan_capture = None
+        if getattr(args, 'plan_root', None):
+            self.plan_history = PlanHistory(args.plan_root)
+            try:
+                self.plan_capture = PlanCapture.install(
+                    self.spark, self.intervals)
+            except Exception as e:
+                print ("Plans are not captured: {}".format(e))
         
 
 
+    def task_arguments(self, task_name):
+        fargs = [self.data_io] + self.data_io.task_inputs(
+            self.data_dict, task_name)
+        return fargs + self.extra_arguments(task_name)
+
+    def run_task(self, task_name):
+        """Build the arguments of task_name and run it; the input encoding
+        is part of the task's time and of its failure handling."""
+        return self.tasks()[task_name](*self.task_arguments(task_name))
+
+    def extra_arguments(self, task_name):
+        """Arguments of task_name besides data_io and its inputs."""
+        if task_name == 'task_5':
+            return list(self.synonmys)
+        return []
+
+    def memo_key(self, task_name):
+        if self.memo is None:
+            return None
+        return self.memo.key(self.data_io, task_name,
+                             self.tasks()[task_name],
+                             self.extra_arguments(task_name))
+
     def arguments(self):
-        arguments = {
-            "task_1": [self.data_io, self.data_dict['review'], self.data_dict['product']],
-            "task_2": [self.data_io, self.data_dict['product']],
-            "task_3": [self.data_io, self.data_dict['product']],
-            "task_4": [self.data_io, self.data_dict['product']],
-            "task_5": [self.data_io, self.data_dict['product_processed']] + self.synonmys,
-            "task_6": [self.data_io, self.data_dict['product_processed']],
-            "task_7": [self.data_io, self.data_dict['ml_features_train'], self.data_dict['ml_features_test']],
-            "task_8": [self.data_io, self.data_dict['ml_features_train'], self.data_dict['ml_features_test']]
-            
-        }
-        return arguments
+        return {task_name: self.task_arguments(task_name)
+                for task_name in self.task_names}
 
     def tasks(self):
         tasks = {
@@ -79,23 +153,40 @@ class PA2Executor(object):
         results = []
         timings = []
         begin = time.time()
-        for part in ['part_1', 'part_2']:
+        self.planner = PersistencePlanner(
+            self.data_io, self.task_names, lookahead=int(self.prefetch))
+        if self.prefetch:
+            self.prefetcher = Prefetcher(
+                self.data_io, self.planner, self.data_dict, self.intervals)
+        self.planner.report()
+        for part, next_part in [('part_1', 'part_2'), ('part_2', None)]:
             print ("Running {} ...".format(part))
-            self.data_dict, self.count_dict = self.data_io.cache_switch(self.data_dict, part)
-            results_part, timings_part = self.eval_by_part(part)
+            results_part, timings_part = self.eval_by_part(part, next_part)
             results += results_part
-            timings += timings_part            
+            timings += timings_part
+        self.planner.report()
+        self.data_io.release_derived()
+        self.data_io.store_join_log()
+        if self.metrics:
+            self.metrics.drain(self.spark.sparkContext)
+        if self.plan_capture:
+            self.compare_plans(timings)
         e2e_dur = time.time()-begin
         print ("End to end time (including data io): {} sec".format(e2e_dur))
         print ("End to end time (excluding data io): {} sec".format(sum(timings)))
         timings.append(e2e_dur)
         return results, timings
 
-    def eval_one(self, task, fargs, task_name):
+    def eval_one(self, task, fargs, task_name, memo_key=None):
         result = False
         try:
             res = task(*fargs)
-            result = self.tests.test(res, task_name)
+            if not self.run_tests:
+                return None
+            with self.test_lock:
+                result = self.tests.test(res, task_name)
+            if memo_key and result:
+                self.memo.put(memo_key, res)
         except Exception as e:
             print(
                 "{} failed to execute, please inspect your code before submission. Exception: {}" \
@@ -104,28 +195,234 @@ class PA2Executor(object):
             traceback.print_exc()
         return result
 
-    def eval_by_part(self, part):
-        results = []
-        timings = []
+    def compare_plans(self, timings):
+        """Store the plans captured for each task and report the tasks whose
+        plans changed structurally since the previous run."""
+        TaskMetricsListener.drain(self.spark.sparkContext)
+        plans = {task_name: [] for task_name in self.task_names}
+        for group in list(self.plan_capture.plans):
+            for task_name in (group or '').split('+'):
+                if task_name in plans:
+                    plans[task_name] += self.plan_capture.plans[group]
+            self.plan_capture.take(group)
+        self.plan_history.compare(
+            {t: '\n'.join(p) for t, p in plans.items()},
+            dict(zip(self.task_names, timings)))
+
+    def enter_group(self, name, description):
+        """Attribute the Spark jobs that follow to name: by job group on
+        pinned threads, otherwise by their start time (see TaskIntervals)."""
+        if self.intervals is None:
+            self.spark.sparkContext.setJobGroup(name, description)
+        else:
+            self.intervals.begin(name)
+
+    def leave_group(self, name):
+        if self.intervals is None:
+            self.spark.sparkContext.setLocalProperty(
+                'spark.jobGroup.id', None)
+        else:
+            self.intervals.end(name)
+
+    def task_metrics(self, task_name):
+        """Spark metrics of task_name's jobs (see TaskMetricsListener)."""
+        if self.metrics is None:
+            return {}
+        return self.metrics.task_metrics(task_name)
+
+    def part_tasks(self, part):
         if part == 'part_1':
-            task_names = self.task_names[:6]
+            return self.task_names[:6]
         elif part == 'part_2':
-            task_names = self.task_names[6:]
-        for task_name in task_names:
-            result, sub_task_dur = self.eval_by_name(task_name)
-            results.append(result)
-            timings.append(sub_task_dur)
-            print ("{} time: {} sec".format(task_name, sub_task_dur))
+            return self.task_names[6:]
+        raise ValueError
+
+    def eval_by_part(self, part, next_part=None):
+        task_names = self.part_tasks(part)
+        outcome = {}
+        if self.memo and not self.force:
+            for task_name in task_names:
+                memoized = self.eval_memoized(task_name)
+                if memoized:
+                    outcome[task_name] = memoized
+        if self.fuse:
+            pending = [t for t in task_names if t not in outcome]
+            for group in self.fusable_groups(pending):
+                outcome.update(self.eval_fused(group))
+        rest = [t for t in task_names if t not in outcome]
+        if self.concurrency > 1:
+            outcome.update(self.eval_concurrent(rest, next_part))
+        else:
+            for i, task_name in enumerate(rest):
+                if self.prefetcher and next_part and i == len(rest) - 1:
+                    # warm the next part while this part's last task runs
+                    self.prefetcher.start(self.part_tasks(next_part))
+                outcome[task_name] = self.eval_by_name(task_name)
+                print ("{} time: {} sec".format(
+                    task_name, outcome[task_name][1]))
+        results = [outcome[task_name][0] for task_name in task_names]
+        timings = [outcome[task_name][1] for task_name in task_names]
         return results, timings
-        
+
+    def fusable_groups(self, task_names):
+        """Tasks that expose a <task>_plan and read the same inputs."""
+        groups = {}
+        for task_name in task_names:
+            if hasattr(self.task_imls, task_name + '_plan'):
+                inputs = tuple(sorted(TASK_INPUTS[task_name]))
+                groups.setdefault(inputs, []).append(task_name)
+        return [group for group in groups.values() if len(group) > 1]
+
+    def eval_fused(self, task_names):
+        """Evaluate the scan-and-aggregate fragments of task_names in a single
+        Spark job and hand each task its share of the values. The time of
+        the shared job is split evenly between the tasks, each of which adds
+        the time of its own finalize. Returns {} if the fused run fails,
+        leaving the tasks to run on their own.
+
+        The tasks get one shared projection of each input, narrowed to the
+        columns any of them reads, so fragments over their inputs share one
+        agg() and the job scans each input once. Work a task can only do
+        with the collected values (e.g. task_3's also_viewed expansion,
+        which needs the price lookup) runs in its finalize."""
+        for task_name in task_names:
+            if self.planner:
+                self.planner.before(task_name, self.data_dict)
+        begin = time.time()
+        group = '+'.join(task_names)
+        self.enter_group(group, 'fused ' + ', '.join(task_names))
+        try:
+            shared = {
+                name: PA2Data.narrow(self.data_dict[name], columns)
+                for name, columns in PA2Data.required_columns(
+                    task_names).items()}
+            plans = [getattr(self.task_imls, task_name + '_plan')(
+                self.data_io,
+                *[shared[name] for name in TASK_INPUTS[task_name]],
+                *self.extra_arguments(task_name))
+                for task_name in task_names]
+            values = aggregate_fragments(
+                [f for fragments, _ in plans for f in fragments])
+        except Exception as e:
+            print ("Fused run of {} failed, running them separately. "
+                   "Exception: {}".format(task_names, e))
+            traceback.print_exc()
+            return {}
+        finally:
+            self.leave_group(group)
+        shared_dur = (time.time() - begin) / len(task_names)
+        outcome = {}
+        i = 0
+        for task_name, (fragments, finalize) in zip(task_names, plans):
+            task_values = values[i:i + len(fragments)]
+            i += len(fragments)
+            finalize_begin = time.time()
+            self.enter_group(task_name, task_name)
+            try:
+                result = self.eval_one(
+                    self.finish_fused, [finalize, task_values, task_name],
+                    task_name, self.memo_key(task_name))
+            finally:
+                self.leave_group(task_name)
+            sub_task_dur = shared_dur + time.time() - finalize_begin
+            if self.planner:
+                self.planner.after(task_name, self.data_dict)
+            outcome[task_name] = (result, sub_task_dur)
+            print ("{} time: {} sec (fused)".format(task_name, sub_task_dur))
+        return outcome
+
+    def finish_fused(self, finalize, values, task_name):
+        res = finalize(values)
+        self.data_io.save(res, task_name)
+        return res
+
+    def eval_memoized(self, task_name):
+        """Save and test the stored result of task_name if its inputs, code
+        and arguments are unchanged since it was stored; None otherwise."""
+        begin = time.time()
+        key = self.memo_key(task_name)
+        res = key and self.memo.get(key)
+        if res is None:
+            return None
+        result = self.eval_one(self.replay, [res, task_name], task_name)
+        sub_task_dur = time.time() - begin
+        if self.planner:
+            self.planner.after(task_name, self.data_dict)
+        print ("{} time: {} sec (memoized)".format(task_name, sub_task_dur))
+        return result, sub_task_dur
+
+    def replay(self, res, task_name):
+        self.data_io.save(res, task_name)
+        return res
+
+    def eval_concurrent(self, task_names, next_part=None):
+        """Run up to concurrency of task_names at once, each on its own
+        thread, starting each task once the tasks it depends on have
+        finished. On pinned threads every task submits its Spark jobs to its
+        own FAIR pool so concurrent tasks share the cluster evenly. Pools
+        would leak between unpinned threads, so there all tasks share the
+        default FAIR pool, which also schedules their jobs fairly."""
+        outcome = {}
+        pending = list(task_names)
+        running = set()
+        finished = queue.Queue()
+        while pending or running:
+            ready = [t for t in pending if all(
+                d in outcome or d not in task_names
+                for d in TASK_DEPENDS.get(t, []))]
+            if not ready and not running:
+                raise ValueError(
+                    'unsatisfiable dependencies among {}'.format(pending))
+            for task_name in ready[:self.concurrency - len(running)]:
+                pending.remove(task_name)
+                if self.prefetcher and next_part and not pending:
+                    self.prefetcher.start(self.part_tasks(next_part))
+                thread = Thread(target=self.eval_in_pool,
+                                args=(task_name, finished))
+                thread.daemon = True
+                thread.start()
+                running.add(task_name)
+            task_name, result, error = finished.get()
+            running.discard(task_name)
+            if error is not None:
+                raise error
+            outcome[task_name] = result
+            print ("{} time: {} sec".format(task_name, result[1]))
+        return outcome
+
+    def eval_in_pool(self, task_name, finished):
+        sc = self.spark.sparkContext
+        pinned = self.intervals is None
+        try:
+            if pinned:
+                sc.setLocalProperty('spark.scheduler.pool', task_name)
+            finished.put((task_name, self.eval_by_name(task_name), None))
+        except Exception as e:
+            finished.put((task_name, None, e))
+        finally:
+            if pinned:
+                sc.setLocalProperty('spark.scheduler.pool', None)
+                sc.setLocalProperty('spark.jobGroup.id', None)
+
     def eval_by_name(self, task_name):
-        arguments, tasks = self.arguments(), self.tasks()
-        fargs = arguments[task_name]
-        task = tasks[task_name]
+        self.data_io.set_task(task_name)
+        if self.plan_capture:
+            self.plan_capture.current = task_name
+        if self.prefetcher:
+            self.prefetcher.wait(task_name)
+        if self.planner:
+            self.planner.before(task_name, self.data_dict)
+        self.enter_group(task_name, task_name)
         sub_task_begin = time.time()
-        result = self.eval_one(task, fargs, task_name)
-        sub_task_end = time.time()
+        try:
+            result = self.eval_one(self.run_task, [task_name], task_name,
+                                   self.memo_key(task_name))
+        finally:
+            sub_task_end = time.time()
+            self.leave_group(task_name)
         sub_task_dur = sub_task_end - sub_task_begin
+        if self.planner:
+            self.planner.after(task_name, self.data_dict)
         return result, sub_task_dur
 
 def get_main_parser():
@@ -159,10 +456,89 @@ def get_main_parser():
         '--module_name', type=str,
         default='assignment2'
     )
+    parser.add_argument(
+        '--master', type=str,
+        default=None,
+        help='Spark master URL, e.g. local[*] (default: the profile\'s)'
+    )
+    parser.add_argument(
+        '--profile', type=str, default='cluster',
+        choices=sorted(SPARK_PROFILES),
+        help='Spark configuration profile'
+    )
+    parser.add_argument(
+        '--auto_tune', action='store_true',
+        help='derive shuffle partitions, broadcast threshold and memory '
+             'fraction from the input sizes and cores'
+    )
     parser.add_argument(
         '--output_root', type=str,
         default=None
     )
+    parser.add_argument(
+        '--conversion_root', type=str,
+        default=None,
+        help='directory for Parquet copies of the CSV inputs; on a '
+             'cluster it must be a mount shared by the driver and executors'
+    )
+    parser.add_argument(
+        '--no_prefetch', dest='prefetch', action='store_false',
+        help='do not warm the next part\'s inputs in the background'
+    )
+    parser.add_argument(
+        '--concurrency', type=int, default=1,
+        help='number of independent tasks to run at once (in per-task '
+             'FAIR pools with pinned PySpark threads, otherwise in one '
+             'shared pool)'
+    )
+    parser.add_argument(
+        '--fuse', action='store_true',
+        help='aggregate tasks that read the same input in one Spark job '
+             'that scans the input once'
+    )
+    parser.add_argument(
+        '--encode_asin', action='store_true',
+        help='give tasks that support it int32 asin ids instead of strings'
+    )
+    parser.add_argument(
+        '--review_state_root', type=str,
+        default=None,
+        help='keep task_1 review state here and ingest only new review '
+             'files (--review_filename may then be a directory); on a '
+             'cluster it must be a mount shared by the driver and executors'
+    )
+    parser.add_argument(
+        '--buckets', type=int,
+        default=None,
+        help='store review and product bucketed and sorted on asin in this '
+             'many buckets (needs --conversion_root)'
+    )
+    parser.add_argument(
+        '--materialize_root', type=str,
+        default=None,
+        help='keep per-row task outputs here as Parquet for reuse; on a '
+             'cluster it must be a mount shared by the driver and executors'
+    )
+    parser.add_argument(
+        '--memo_root', type=str,
+        default=None,
+        help='reuse task results that passed their tests, stored here, '
+             'while the task\'s inputs, code and arguments are unchanged'
+    )
+    parser.add_argument(
+        '--memo_entries', type=int, default=64,
+        help='number of task results kept under --memo_root'
+    )
+    parser.add_argument(
+        '--force', action='store_true',
+        help='run every task even if a stored result is valid'
+    )
+    parser.add_argument(
+        '--plan_root', type=str,
+        default=None,
+        help='capture the physical plans of every task here and report '
+             'plan changes since the previous run'
+    )
     parser.add_argument('--synonmys', nargs='+', type=str, default=['piano', 'rice', 'laptop'])
     return parser
         
@@ -179,6 +555,10 @@ if __name__ == "__main__":
     results, timings = pa2.eval()
     res = []
     for task_name, result, timing in zip(TASK_NAMES, results, timings):
-        res.append({'task_name': task_name,
-                   'passed': result, 'time_sec': timing})
+        row = {'task_name': task_name, 'passed': result, 'time_sec': timing}
+        row.update(pa2.task_metrics(task_name))
+        res.append(row)
+    res.append({'task_name': 'spark_config',
+                'config': spark_config(pa2.spark)})
     pa2.data_io.save(res, 'summary')
+    pa2.data_io.flush()
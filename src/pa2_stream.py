@@ -0,0 +1,109 @@
+import importlib
+import os
+import getpass
+import pyspark.sql.functions as F
+from utilities import spark_init
+from utilities import PA2Data
+from utilities import TASK_INPUTS
+from utilities import rollup_reviews
+from pa2_main import get_main_parser
+
+
+class PA2Stream(object):
+    """Keep the task_1 review state current from a directory that review CSV
+    files keep landing in. Each file is read once by the streaming file
+    source; ratings are rolled up per asin in ingestion-time windows, and a
+    window is merged into the ReviewRollupStore once the watermark closes
+    it, so the streaming state only ever holds the open windows. A window
+    reaches the store about one trigger after it ends. Every micro-batch
+    that merged something also saves a fresh task_1 result."""
+    def __init__(self, args, task_imls):
+        self.args = args
+        self.task_imls = task_imls
+        self.spark = spark_init(args.pid, args.master, profile=args.profile)
+        # no 'review' path: task_1 reads the store state as it is, the
+        # stream is the only thing that adds to it
+        self.data_io = PA2Data(
+            self.spark,
+            {'product': args.product_filename},
+            args.output_root,
+            deploy=True,
+            conversion_root=args.conversion_root,
+            review_state_root=args.review_state_root
+        )
+        self.store = self.data_io.review_store
+        product_data = self.data_io.load('product', args.product_filename)
+        self.product_data = PA2Data.narrow(
+            product_data, TASK_INPUTS['task_1']['product']).cache()
+
+    def rollups(self):
+        reviews = self.spark.readStream.csv(
+            self.args.review_dir,
+            schema=PA2Data.review_schema,
+            escape='"',
+            quote='"',
+            header=True,
+            maxFilesPerTrigger=self.args.max_files_per_trigger
+        )
+        # the review data carries no event time of its own, so windows are
+        # over ingestion time; the watermark drops their state once closed
+        reviews = reviews.withColumn('ingested_at', F.current_timestamp()) \
+            .withWatermark('ingested_at', self.args.watermark)
+        return rollup_reviews(
+            reviews, [F.window('ingested_at', self.args.window), 'asin'])
+
+    def process(self, batch, batch_id):
+        if not batch.head(1):
+            return
+        # the batch holds the windows closed since the last one; windows
+        # of the same asin are summed by the merge
+        self.store.merge(batch.drop('window'), batch_id=batch_id)
+        self.task_imls.task_1(self.data_io, None, self.product_data)
+        print ("batch {}: task_1 snapshot saved".format(batch_id))
+
+    def run(self):
+        query = self.rollups().writeStream \
+            .outputMode('append') \
+            .foreachBatch(self.process) \
+            .trigger(processingTime=self.args.trigger_interval) \
+            .option('checkpointLocation',
+                    os.path.join(self.args.review_state_root, 'checkpoint')) \
+            .start()
+        query.awaitTermination()
+
+
+def get_stream_parser():
+    parser = get_main_parser()
+    parser.add_argument(
+        '--review_dir', type=str, required=True,
+        help='directory watched for new review CSV files'
+    )
+    parser.add_argument(
+        '--trigger_interval', type=str, default='1 minute'
+    )
+    parser.add_argument(
+        '--window', type=str, default='1 minute',
+        help='ingestion-time window the reviews are rolled up in'
+    )
+    parser.add_argument(
+        '--watermark', type=str, default='0 seconds',
+        help='how long a window stays open after its end'
+    )
+    parser.add_argument(
+        '--max_files_per_trigger', type=int, default=100
+    )
+    return parser
+
+
+if __name__ == "__main__":
+
+    parser = get_stream_parser()
+    args = parser.parse_args()
+    username = getpass.getuser()
+    if not args.output_root:
+        args.output_root = '/home/{}/{}-pa2/test_results'.format(
+            username, args.pid)
+    if not args.review_state_root:
+        args.review_state_root = os.path.join(args.output_root, 'review_state')
+    task_imls = importlib.import_module(args.module_name)
+    PA2Stream(args, task_imls).run()
@@ -1,15 +1,56 @@
+from pyspark import StorageLevel
+from pyspark.broadcast import Broadcast
+try:
+    from pyspark import InheritableThread as Thread
+except ImportError:
+    from threading import Thread
 from pyspark.sql import SparkSession
+from pyspark.sql import DataFrame
+from pyspark.sql import Row
 import pyspark.sql.functions as F
 import pyspark.sql.types as T
 import databricks.koalas as ks
 import numpy as np
 import os
+import json
+import queue
+import uuid
+import atexit
+import inspect
+import re
+import time
+import difflib
+import pickle
+import shutil
+import base64
+import hashlib
+import math
+import threading
 import traceback
-from collections import Mapping
+from collections import Mapping, MutableMapping, Counter
 from math import isclose
 SEED = 102
 TASK_NAMES = ['task_' + str(i) for i in range(1, 9)]
 EXT = '.json'
+# Columns each task reads from each of its inputs; None means all columns.
+TASK_INPUTS = {
+    'task_1': {'review': ['asin', 'reviewerID', 'overall'],
+               'product': ['asin']},
+    'task_2': {'product': ['asin', 'salesRank', 'categories']},
+    'task_3': {'product': ['asin', 'price', 'related']},
+    'task_4': {'product': ['asin', 'price', 'title']},
+    'task_5': {'product_processed': ['asin', 'title']},
+    'task_6': {'product_processed': ['asin', 'category']},
+    'task_7': {'ml_features_train': None, 'ml_features_test': None},
+    'task_8': {'ml_features_train': None, 'ml_features_test': None}
+}
+# Tasks that must finish before a task may start. The PA2 tasks share no
+# state, so any of them may run concurrently.
+TASK_DEPENDS = {task_name: [] for task_name in TASK_NAMES}
+# Tasks that accept asin_id in place of asin (see PA2Data.encoded).
+ASIN_ENCODED_TASKS = ['task_1']
+# Inputs stored bucketed and sorted on asin (see PA2Data.bucketed_table).
+BUCKETED_INPUTS = ['review', 'product']
 MASTER_IP = 'spark://0.0.0.0:7077'
 
 
@@ -22,27 +63,843 @@ class data_cat:
     test_results_root = '/ds102-wi22-a00-public/test_results'
 
 
-def quantile(rdd, p, sample=None, seed=SEED):
-    """Compute a quantile of order p ∈ [0, 1]
+def uri(path):
+    """Qualify a bare local path with file:// so Spark does not resolve it
+    against the default (possibly distributed) filesystem."""
+    return path if '://' in path else 'file://' + path
+
+
+def local_path(path):
+    return path[len('file://'):] if path.startswith('file://') else path
+
+
+def check_shared_root(spark, root):
+    """Raise ValueError unless the executors see root, a driver directory
+    Spark writes to as a file:// path: without a mount shared with the
+    driver each executor writes its part files to its own disk, while the
+    driver's _SUCCESS and manifest checks still pass. Local masters share
+    the driver's disk and are not checked."""
+    sc = spark.sparkContext
+    if sc.master.startswith('local'):
+        return
+    root = local_path(root)
+    os.makedirs(root, exist_ok=True)
+    marker = os.path.join(root, '.shared-' + uuid.uuid4().hex)
+    open(marker, 'w').close()
+    try:
+        n = max(sc.defaultParallelism, executor_count(sc))
+        seen = sc.parallelize(range(n), n) \
+            .map(lambda _: os.path.exists(marker)).collect()
+    finally:
+        os.remove(marker)
+    if not all(seen):
+        raise ValueError(
+            '{} is not shared with the executors; use a directory on a '
+            'mount every node sees'.format(root))
+
+
+def path_fingerprint(path):
+    """Identity of a local file or directory: absolute path, total size in
+    bytes and latest mtime. Returns None if the path is not on a local or
+    mounted filesystem."""
+    path = local_path(path)
+    if '://' in path or not os.path.exists(path):
+        return None
+    if os.path.isdir(path):
+        size, mtime = 0, 0.0
+        for root, _, files in os.walk(path):
+            for f in files:
+                st = os.stat(os.path.join(root, f))
+                size += st.st_size
+                mtime = max(mtime, st.st_mtime)
+    else:
+        st = os.stat(path)
+        size, mtime = st.st_size, st.st_mtime
+    return {'path': os.path.abspath(path), 'size': size, 'mtime': mtime}
+
+
+def digest(obj, length=16):
+    return hashlib.sha1(
+        json.dumps(obj, sort_keys=True).encode('utf-8')).hexdigest()[:length]
+
+
+def parse_bytes(size):
+    """Parse a JVM/Spark size string such as '18G' or '512m' to bytes."""
+    units = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+    size = str(size).strip().lower().rstrip('b')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def same_plan(a, b):
+    if a is b:
+        return True
+    try:
+        return a.sameSemantics(b)
+    except AttributeError:
+        # DataFrame.sameSemantics needs Spark 3.1
+        return False
+
+
+def aggregate_fragments(fragments):
+    """Evaluate aggregation fragments in one Spark job.
+
+    :fragments list of (DataFrame, [aggregate Column, ...]) pairs
+    Fragments over the same DataFrame (the same object, or on Spark 3.1+ the
+    same plan) share a single agg(), and so a single scan; the one-row
+    results of the different DataFrames are unioned so a single collect()
+    fetches all of them, though each branch of the union reads its own
+    input. Returns one dict per fragment that maps the column name each
+    expression would have in DataFrame.agg() to its value.
+    """
+    groups = []
+    layout = []
+    for i, (df, exprs) in enumerate(fragments):
+        names = df.agg(*exprs).columns
+        aliases = ['f{}_{}'.format(i, j) for j in range(len(exprs))]
+        for k, (group_df, _, _) in enumerate(groups):
+            if same_plan(group_df, df):
+                break
+        else:
+            k = len(groups)
+            groups.append((df, [], []))
+        groups[k][1].extend(
+            expr.alias(alias) for expr, alias in zip(exprs, aliases))
+        groups[k][2].extend(aliases)
+        layout.append((k, names, aliases))
+    unioned = None
+    for k, (df, exprs, aliases) in enumerate(groups):
+        aggregated = df.agg(*exprs).select(
+            F.lit(k).alias('group'),
+            F.to_json(F.struct(*aliases)).alias('values'))
+        unioned = aggregated if unioned is None else unioned.union(aggregated)
+    rows = {row['group']: json.loads(row['values'])
+            for row in unioned.collect()}
+    # to_json leaves out nulls
+    return [{name: rows[k].get(alias) for name, alias in zip(names, aliases)}
+            for k, names, aliases in layout]
+
+
+class Moments(object):
+    """Count, mean and sum of squared deviations of a stream of numbers,
+    updated with Welford's method and merged with Chan et al.'s formula."""
+
+    def __init__(self, n=0, mean=0.0, m2=0.0):
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+        return self
+
+    def merge(self, other):
+        if other.n:
+            n = self.n + other.n
+            delta = other.mean - self.mean
+            self.mean += delta * other.n / n
+            self.m2 += other.m2 + delta * delta * self.n * other.n / n
+            self.n = n
+        return self
+
+    def variance(self):
+        """Sample variance, as F.variance computes it."""
+        return self.m2 / (self.n - 1) if self.n > 1 else None
+
+    def to_dict(self):
+        return {'n': self.n, 'mean': self.mean, 'm2': self.m2}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['n'], d['mean'], d['m2'])
+
+
+class HyperLogLog(object):
+    """Distinct-count sketch with 2**p one-byte registers; the standard error
+    of the estimate is about 1.04 / sqrt(2**p)."""
+
+    def __init__(self, p=14, registers=None):
+        self.p = p
+        self.registers = registers or bytearray(1 << p)
+
+    def add(self, value):
+        h = int.from_bytes(hashlib.blake2b(
+            repr(value).encode('utf-8'), digest_size=8).digest(), 'big')
+        index = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = 64 - self.p - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+        return self
+
+    def merge(self, other):
+        assert self.p == other.p
+        self.registers = bytearray(
+            max(a, b) for a, b in zip(self.registers, other.registers))
+        return self
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        e = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if e <= 2.5 * m and zeros:
+            e = m * math.log(float(m) / zeros)
+        return int(round(e))
+
+    def to_dict(self):
+        return {'p': self.p, 'registers': base64.b64encode(
+            bytes(self.registers)).decode('ascii')}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['p'], bytearray(base64.b64decode(d['registers'])))
+
+
+class TDigest(object):
+    """Merging t-digest (Dunning & Ertl) for quantiles of a stream. Centroid
+    sizes are bounded by 4 n q (1 - q) / delta, so the rank error is
+    smallest in the tails and about 1 / delta around the median."""
+
+    def __init__(self, delta=100, centroids=None, buffer_size=1000):
+        self.delta = delta
+        self.centroids = centroids or []
+        self.buffer = []
+        self.buffer_size = buffer_size
+        self.min = min(c[0] for c in self.centroids) if self.centroids else None
+        self.max = max(c[0] for c in self.centroids) if self.centroids else None
+
+    @property
+    def n(self):
+        return sum(w for _, w in self.centroids) + len(self.buffer)
+
+    def add(self, x):
+        self.buffer.append(x)
+        self.min = x if self.min is None else min(self.min, x)
+        self.max = x if self.max is None else max(self.max, x)
+        if len(self.buffer) >= self.buffer_size:
+            self.compress()
+        return self
+
+    def compress(self):
+        points = self.centroids + [[x, 1] for x in self.buffer]
+        self.buffer = []
+        if not points:
+            return
+        points.sort(key=lambda c: c[0])
+        total = float(sum(w for _, w in points))
+        merged = [list(points[0])]
+        before = 0.0
+        for mean, weight in points[1:]:
+            last = merged[-1]
+            q = (before + (last[1] + weight) / 2.0) / total
+            if last[1] + weight <= max(4 * total * q * (1 - q) / self.delta, 1):
+                last[1] += weight
+                last[0] += (mean - last[0]) * weight / last[1]
+            else:
+                before += last[1]
+                merged.append([mean, weight])
+        self.centroids = merged
+
+    def merge(self, other):
+        other.compress()
+        self.centroids = self.centroids + [list(c) for c in other.centroids]
+        for bound in (other.min, other.max):
+            if bound is not None:
+                self.min = bound if self.min is None else min(self.min, bound)
+                self.max = bound if self.max is None else max(self.max, bound)
+        self.compress()
+        return self
+
+    def quantile(self, q):
+        self.compress()
+        centroids = self.centroids
+        if not centroids:
+            return None
+        target = q * sum(w for _, w in centroids)
+        before = 0.0
+        for i, (mean, weight) in enumerate(centroids):
+            center = before + weight / 2.0
+            if target <= center:
+                if i == 0:
+                    lo, lo_center = self.min, 0.0
+                else:
+                    lo = centroids[i - 1][0]
+                    lo_center = before - centroids[i - 1][1] / 2.0
+                if center == lo_center:
+                    return mean
+                return lo + (mean - lo) * (target - lo_center) / (center - lo_center)
+            before += weight
+        last_center = before - centroids[-1][1] / 2.0
+        if before == last_center:
+            return self.max
+        return centroids[-1][0] + (self.max - centroids[-1][0]) * \
+            (target - last_center) / (before - last_center)
+
+    def to_dict(self):
+        self.compress()
+        return {'delta': self.delta, 'centroids': self.centroids,
+                'min': self.min, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, d):
+        digest = cls(d['delta'], [list(c) for c in d['centroids']])
+        digest.min, digest.max = d['min'], d['max']
+        return digest
+
+
+class ColumnProfile(object):
+    """Non-null count, nulls, moments and optional distinct-count and
+    quantile sketches of one column."""
+
+    def __init__(self, distinct=False, quantiles=False):
+        self.count = 0
+        self.nulls = 0
+        self.moments = Moments()
+        self.hll = HyperLogLog() if distinct else None
+        self.digest = TDigest() if quantiles else None
+
+    def add(self, value):
+        if value is None:
+            self.nulls += 1
+            return self
+        self.count += 1
+        if self.hll is not None:
+            self.hll.add(value)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            self.moments.add(value)
+            if self.digest is not None:
+                self.digest.add(value)
+        return self
+
+    def merge(self, other):
+        self.count += other.count
+        self.nulls += other.nulls
+        self.moments.merge(other.moments)
+        if self.hll is not None and other.hll is not None:
+            self.hll.merge(other.hll)
+        if self.digest is not None and other.digest is not None:
+            self.digest.merge(other.digest)
+        return self
+
+    def to_dict(self):
+        return {
+            'count': self.count, 'nulls': self.nulls,
+            'moments': self.moments.to_dict(),
+            'hll': self.hll.to_dict() if self.hll is not None else None,
+            'digest': self.digest.to_dict() if self.digest is not None else None
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        profile = cls()
+        profile.count, profile.nulls = d['count'], d['nulls']
+        profile.moments = Moments.from_dict(d['moments'])
+        if d['hll'] is not None:
+            profile.hll = HyperLogLog.from_dict(d['hll'])
+        if d['digest'] is not None:
+            profile.digest = TDigest.from_dict(d['digest'])
+        return profile
+
+
+class TableProfile(object):
+    """Mergeable profile of a set of columns; see profile_columns."""
+
+    def __init__(self, columns, distinct=(), quantiles=()):
+        self.columns = list(columns)
+        self.rows = 0
+        self.profiles = {
+            c: ColumnProfile(c in distinct, c in quantiles) for c in columns}
+
+    def add(self, row):
+        self.rows += 1
+        for column, value in zip(self.columns, row):
+            self.profiles[column].add(value)
+        return self
+
+    def merge(self, other):
+        self.rows += other.rows
+        for column in self.columns:
+            self.profiles[column].merge(other.profiles[column])
+        return self
+
+    def quantile(self, column, q):
+        return self.profiles[column].digest.quantile(q)
+
+    def res(self, names=None):
+        """Statistics under the res keys the tasks report: count_total plus
+        mean_, variance_, numNulls_ and, for distinct-counted columns,
+        countDistinct_ for each column. names renames columns."""
+        names = names or {}
+        res = {'count_total': self.rows}
+        for column in self.columns:
+            name = names.get(column, column)
+            profile = self.profiles[column]
+            if profile.moments.n:
+                res['mean_' + name] = profile.moments.mean
+                res['variance_' + name] = profile.moments.variance()
+            res['numNulls_' + name] = profile.nulls
+            if profile.hll is not None:
+                res['countDistinct_' + name] = profile.hll.estimate()
+        return res
+
+    def to_dict(self):
+        return {'columns': self.columns, 'rows': self.rows,
+                'profiles': {c: p.to_dict() for c, p in self.profiles.items()}}
+
+    @classmethod
+    def from_dict(cls, d):
+        profile = cls(d['columns'])
+        profile.rows = d['rows']
+        profile.profiles = {c: ColumnProfile.from_dict(p)
+                            for c, p in d['profiles'].items()}
+        return profile
+
+
+def profile_columns(data, columns=None, distinct=(), quantiles=()):
+    """Profile columns of a DataFrame (or an RDD of tuples) in one pass.
+
+    :data DataFrame, or RDD whose rows line up with columns
+    :columns columns to profile, all of them by default (for an RDD, the
+        fields of its first Row, or _1, _2, ... for tuples)
+    :distinct columns to estimate distinct counts of (HyperLogLog)
+    :quantiles numeric columns to keep a t-digest of
+    Partition profiles are merged on the way to the driver; the result can
+    be serialized with to_dict() and merged with later profiles.
+    """
+    if isinstance(data, DataFrame):
+        columns = columns or data.columns
+        data = data.select(*columns).rdd
+    elif columns is None:
+        first = data.take(1)
+        if not first:
+            raise ValueError('cannot name the columns of an empty RDD; '
+                             'pass columns')
+        columns = getattr(first[0], '__fields__', None) or \
+            ['_' + str(i + 1) for i in range(len(first[0]))]
+    zero = TableProfile(columns, distinct, quantiles)
+    return data.treeAggregate(
+        zero, lambda profile, row: profile.add(row),
+        lambda a, b: a.merge(b))
+
+
+class ColumnImputer(object):
+    """Fill the nulls of numeric columns with their mean or median, over the
+    whole table or per group.
+
+    :strategies {output column: (input column, 'mean' or 'median')}
+    :group_by column whose groups get their own fill values
+    :median 'exact' uses Spark's percentile aggregate, which keeps a count
+        per distinct value rather than sorting; 'approx' uses
+        percentile_approx with the given accuracy (rank error 1 / accuracy)
+    fit() computes every fill value in a single aggregation; without
+    group_by, aggregates() and fit_values() let that aggregation run with
+    others. transform() applies them as expressions (group-wise fills as a
+    literal map), so the fill runs inside the job that consumes its output.
+    """
+
+    def __init__(self, strategies, group_by=None, median='exact',
+                 accuracy=10000):
+        assert median in ['exact', 'approx']
+        self.strategies = strategies
+        self.group_by = group_by
+        self.median = median
+        self.accuracy = accuracy
+        self.fills = None
+
+    def aggregate(self, column, strategy):
+        if strategy == 'mean':
+            return F.avg(F.col(column))
+        elif strategy == 'median' and self.median == 'exact':
+            return F.expr('percentile(`{}`, 0.5)'.format(column))
+        elif strategy == 'median':
+            return F.expr('percentile_approx(`{}`, 0.5, {})'.format(
+                column, self.accuracy))
+        raise ValueError(strategy)
+
+    def aggregates(self):
+        """The fill value aggregates, named by output column."""
+        return [self.aggregate(column, strategy).alias(output)
+                for output, (column, strategy) in self.strategies.items()]
+
+    def fit_values(self, values):
+        """Take the fill values from a row (or dict) of aggregates()."""
+        assert self.group_by is None
+        self.fills = {output: values[output] for output in self.strategies}
+        return self
+
+    def fit(self, data):
+        exprs = self.aggregates()
+        if self.group_by is None:
+            self.fit_values(data.agg(*exprs).collect()[0])
+        else:
+            rows = data.groupBy(self.group_by).agg(*exprs).collect()
+            self.fills = {
+                output: {row[self.group_by]: row[output] for row in rows
+                         if row[self.group_by] is not None}
+                for output in self.strategies}
+        return self
+
+    def fill(self, output):
+        column = F.col(self.strategies[output][0])
+        value = self.fills[output]
+        if self.group_by is None:
+            return F.coalesce(column, F.lit(value))
+        if not value:
+            return column
+        lookup = F.create_map(*[F.lit(x) for kv in value.items() for x in kv])
+        return F.coalesce(column, lookup[F.col(self.group_by)])
+
+    def transform(self, data):
+        assert self.fills is not None, 'fit() first'
+        return data.select(
+            '*', *[self.fill(output).alias(output) for output in self.strategies])
+
+
+class SortedLookup(object):
+    """Compact key -> value map for broadcasting: a sorted numpy array of
+    keys (fixed-width bytes for strings) and the aligned values, probed by
+    binary search. Ten-character asins cost ten bytes a key, against well
+    over a hundred for a Python dict entry. Values may be rows of several
+    numbers (see aggregated)."""
+
+    def __init__(self, keys, values):
+        order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[order]
+        self.values = values[order]
+
+    @classmethod
+    def aggregated(cls, keys, values):
+        """Lookup from each distinct non-null key to the number of its rows
+        and the sum and count of their non-null values: what a left join on
+        key against the (key, value) rows contributes to an aggregate."""
+        pairs = [(k, v) for k, v in zip(keys, values) if k is not None]
+        if not pairs:
+            return cls(np.array([]), np.zeros((0, 3)))
+        values = np.array([np.nan if v is None else v for _, v in pairs],
+                          dtype=np.float64)
+        keys, inverse = np.unique(cls.encode([k for k, _ in pairs]),
+                                  return_inverse=True)
+        known = ~np.isnan(values)
+        return cls(keys, np.column_stack([
+            np.bincount(inverse),
+            np.bincount(inverse, weights=np.where(known, values, 0.0)),
+            np.bincount(inverse, weights=known)]))
+
+    @classmethod
+    def from_dataframe(cls, data, key_column, value_column):
+        """aggregated() over the (key, value) rows of data."""
+        pdf = data.select(key_column, value_column).where(
+            F.col(key_column).isNotNull()).toPandas()
+        return cls.aggregated(pdf[key_column].values, pdf[value_column].values)
+
+    @classmethod
+    def from_records(cls, records, key_column, value_column):
+        """aggregated() over a list of dicts, e.g. a collected list of
+        structs (missing fields are null)."""
+        records = records or []
+        return cls.aggregated([r.get(key_column) for r in records],
+                              [r.get(value_column) for r in records])
+
+    @staticmethod
+    def encode(keys):
+        if len(keys) and isinstance(keys[0], str):
+            return np.array([k.encode('utf-8') for k in keys])
+        return np.asarray(keys)
+
+    def get(self, keys):
+        """Values of keys as float64, NaN where a key is absent."""
+        keys = self.encode(keys)
+        shape = (len(keys),) + self.values.shape[1:]
+        if not len(keys) or not len(self.keys):
+            return np.full(shape, np.nan)
+        index = np.searchsorted(self.keys, keys)
+        index[index == len(self.keys)] = 0
+        found = self.keys[index] == keys
+        values = self.values[index].astype(np.float64)
+        values[~found] = np.nan
+        return values
+
+
+def lookup_list_stats(data, key_column, list_column, lookup, count_column,
+                      mean_column):
+    """Per key of data, what a left join of its exploded list_column against
+    the rows behind an aggregated() lookup gives: count_column counts the
+    non-null entries, an entry with several rows once per row, and
+    mean_column averages the non-null values they match (null if none).
+    Rows with the same key, null included, are merged like a groupBy. The
+    lookup is broadcast and the lists are expanded where each row lives, so
+    only one partial row per data row is shuffled, never the exploded ones.
+
+    :list_column name or Column of an array of keys
+    :lookup the lookup, or a Broadcast of it; pass the Broadcast to be able
+        to unpersist it once the result has been collected
+    """
+    spark = SparkSession.builder.getOrCreate()
+    if isinstance(lookup, Broadcast):
+        table = lookup
+    else:
+        table = spark.sparkContext.broadcast(lookup)
+    if isinstance(list_column, str):
+        list_column = F.col(list_column)
+
+    def expand(rows):
+        lookup = table.value
+        for key, entries in rows:
+            entries = [e for e in entries or [] if e is not None]
+            stats = lookup.get(entries)
+            # an entry without a match still joins as one row
+            matches = np.maximum(np.nan_to_num(stats[:, 0]), 1)
+            yield (key, int(matches.sum()), float(np.nansum(stats[:, 1])),
+                   int(np.nansum(stats[:, 2])))
+
+    schema = T.StructType([
+        T.StructField(key_column, data.schema[key_column].dataType),
+        T.StructField('_count', T.LongType()),
+        T.StructField('_sum', T.DoubleType()),
+        T.StructField('_known', T.LongType())
+    ])
+    rows = data.select(F.col(key_column), list_column).rdd.mapPartitions(expand)
+    partial = spark.createDataFrame(rows, schema)
+    return partial.groupBy(key_column).agg(
+        F.sum('_count').alias(count_column),
+        F.when(F.sum('_known') > 0, F.sum('_sum') / F.sum('_known'))
+        .alias(mean_column))
+
+
+class SkewProfiler(object):
+    """Sampled key frequencies of a DataFrame column. A key is a heavy hitter
+    when its estimated row count exceeds skew_factor times the rows of an
+    average shuffle partition, i.e. when the task that receives it would
+    straggle in a shuffle on that key."""
+
+    def __init__(self, fraction=0.01, top=20, skew_factor=4.0, seed=SEED):
+        self.fraction = fraction
+        self.top = top
+        self.skew_factor = skew_factor
+        self.seed = seed
+
+    def profile(self, data, key, partitions=None):
+        """dict of the estimated rows and distinct keys of data, and its
+        heavy hitters as [key, estimated rows] pairs, heaviest first."""
+        if partitions is None:
+            partitions = int(data.sql_ctx.sparkSession.conf.get(
+                'spark.sql.shuffle.partitions'))
+        counts = data.select(F.col(key).alias('key')) \
+            .where(F.col('key').isNotNull()) \
+            .sample(False, self.fraction, self.seed) \
+            .groupBy('key').count()
+        top = counts.orderBy(F.desc('count')).limit(self.top)
+        # totals ride along with the top keys in one job
+        totals = counts.agg(F.sum('count').alias('rows'),
+                            F.count(F.lit(1)).alias('keys'))
+        rows = top.crossJoin(totals).collect()
+        if not rows:
+            return {'rows': 0, 'keys': 0, 'heavy': []}
+        scale = 1.0 / self.fraction
+        n = rows[0]['rows'] * scale
+        limit = self.skew_factor * n / max(partitions, 1)
+        heavy = [[r['key'], int(r['count'] * scale)] for r in rows
+                 if r['count'] * scale > limit]
+        return {'rows': int(n), 'keys': int(rows[0]['keys'] * scale),
+                'heavy': heavy}
+
+
+class JoinPlanner(object):
+    """Picks a strategy for an equi-join on one key column:
+    broadcast   -- the right side's estimated size fits the threshold;
+    salted      -- the left side has heavy hitters: their left rows are
+                   spread over salt_buckets salts and their right rows
+                   replicated to every salt, so no one task receives a whole
+                   heavy key;
+    sort_merge  -- otherwise, Spark's default.
+    Broadcast and salting keep every left row and at most replicate right
+    rows per salt, so they are only used for inner, left, left_semi and
+    left_anti joins."""
+    LEFT_JOINS = ['inner', 'left', 'left_outer', 'left_semi', 'left_anti']
+
+    def __init__(self, profiler=None, broadcast_threshold=None,
+                 salt_buckets=16):
+        self.profiler = profiler or SkewProfiler()
+        self.broadcast_threshold = broadcast_threshold
+        self.salt_buckets = salt_buckets
+
+    @staticmethod
+    def estimated_size(data):
+        """Optimizer size estimate of data in bytes, None if unknown."""
+        try:
+            return int(data._jdf.queryExecution().optimizedPlan()
+                       .stats().sizeInBytes().toString())
+        except Exception:
+            return None
+
+    def threshold(self, data):
+        if self.broadcast_threshold is not None:
+            return self.broadcast_threshold
+        return parse_bytes(data.sql_ctx.sparkSession.conf.get(
+            'spark.sql.autoBroadcastJoinThreshold'))
+
+    def choose(self, left, right, key, how, unique_left=False):
+        """(strategy, details) for joining left and right on key. A caller
+        that knows key is unique in left passes unique_left to skip the
+        skew profile, which cannot find a heavy key there."""
+        if how not in self.LEFT_JOINS:
+            return 'sort_merge', {'reason': how + ' join'}
+        size = self.estimated_size(right)
+        if size is not None and 0 <= size <= self.threshold(right):
+            return 'broadcast', {'right_bytes': size}
+        if unique_left:
+            return 'sort_merge', {'right_bytes': size,
+                                  'reason': 'unique left key'}
+        profile = self.profiler.profile(left, key)
+        if profile['heavy']:
+            return 'salted', profile
+        return 'sort_merge', {'right_bytes': size, 'left_rows': profile['rows']}
+
+    def join(self, left, right, key, how='inner', unique_left=False):
+        """left joined with right on key, with the strategy and details
+        chosen for it."""
+        strategy, details = self.choose(left, right, key, how, unique_left)
+        if strategy == 'broadcast':
+            joined = left.join(F.broadcast(right), key, how)
+        elif strategy == 'salted':
+            n = self.salt_buckets
+            is_heavy = F.col(key).isin([k for k, _ in details['heavy']])
+            left = left.withColumn('_salt', F.when(
+                is_heavy, (F.rand(self.profiler.seed) * n).cast('int')
+            ).otherwise(0))
+            right = right.withColumn('_salt', F.explode(F.when(
+                is_heavy, F.array(*[F.lit(i) for i in range(n)])
+            ).otherwise(F.array(F.lit(0)))))
+            joined = left.join(right, [key, '_salt'], how).drop('_salt')
+        else:
+            joined = left.join(right, key, how)
+        return joined, strategy, details
+
+
+def quantile(rdd, p, sample=None, seed=SEED, relative_error=None,
+             buckets=1024, collect_limit=1 << 17, max_passes=6):
+    """Compute quantiles of order p ∈ [0, 1] without sorting the rdd
     :rdd a numeric rdd
-    :p quantile(between 0 and 1)
+    :p quantile(between 0 and 1), or a list of them
     :sample fraction of and rdd to use. If not provided we use a whole dataset
     :seed random number generator seed to be used with sample
+    :relative_error if given, return approximate quantiles whose rank is
+        within relative_error * n of the exact rank, in a single pass
+        (Greenwald-Khanna, via DataFrame.approxQuantile)
+    :buckets histogram resolution of each refining pass
+    :collect_limit number of candidate values small enough to select on the
+        driver
+    :max_passes passes after which the remaining candidates are collected
+        whatever their number
+    Exact quantiles interpolate linearly between the order statistics
+    around (n - 1) * p. They are found by histogram refinement: one pass for
+    count, min and max, then each pass histograms only the values inside the
+    buckets that hold a wanted order statistic, narrowing them by a factor of
+    `buckets`, until few enough candidates remain to collect.
     """
-    assert 0 <= p <= 1
+    ps = list(p) if isinstance(p, (list, tuple)) else [p]
+    assert all(0 <= q <= 1 for q in ps)
     assert sample is None or 0 < sample <= 1
 
     rdd = rdd if sample is None else rdd.sample(False, sample, seed)
+    rdd = rdd.filter(lambda x: x is not None).map(float)
+
+    if relative_error is not None:
+        spark = SparkSession.builder.getOrCreate()
+        values = spark.createDataFrame(rdd.map(lambda x: (x,)), ['value']) \
+            .approxQuantile('value', ps, relative_error)
+        return values if isinstance(p, (list, tuple)) else values[0]
+
+    rdd = rdd.persist(StorageLevel.MEMORY_AND_DISK)
+    try:
+        stats = rdd.stats()
+        n = stats.count()
+        if n == 0:
+            raise ValueError('quantile of an empty rdd')
+        h = [(n - 1) * q for q in ps]
+        ranks = set()
+        for x in h:
+            ranks.update([int(np.floor(x)), min(int(np.floor(x)) + 1, n - 1)])
+        values = select_ranks(rdd, sorted(ranks), n, stats.min(), stats.max(),
+                              buckets, collect_limit, max_passes)
+    finally:
+        rdd.unpersist()
+
+    res = []
+    for x in h:
+        lo = values[int(np.floor(x))]
+        hi = values[min(int(np.floor(x)) + 1, n - 1)]
+        res.append(lo + (x - np.floor(x)) * (hi - lo))
+    return res if isinstance(p, (list, tuple)) else res[0]
+
+
+def select_ranks(rdd, ranks, n, lo, hi, buckets, collect_limit, max_passes):
+    """Values of the given 0-based order statistics of a float rdd whose
+    count, min and max are known. Returns {rank: value}."""
+    values = {}
+    # (lo, hi, number of values below lo) -> (ranks inside, values inside)
+    intervals = {(lo, hi, 0): (list(ranks), n)}
+    passes = 1
+    while intervals:
+        bounds = list(intervals)
+        if sum(size for _, size in intervals.values()) <= collect_limit \
+                or passes >= max_passes:
+            collected = rdd.filter(
+                lambda x: any(a <= x <= b for a, b, _ in bounds)).collect()
+            for a, b, below in bounds:
+                inside = sorted(x for x in collected if a <= x <= b)
+                for rank in intervals[(a, b, below)][0]:
+                    values[rank] = inside[rank - below]
+            break
+        if lo == hi:
+            for rank in ranks:
+                values[rank] = lo
+            break
+        histograms = interval_histograms(rdd, bounds, buckets)
+        refined = {}
+        for (a, b, below), (counts, mins, maxs) in zip(bounds, histograms):
+            cumulative = below + np.cumsum(counts)
+            for rank in intervals[(a, b, below)][0]:
+                k = int(np.searchsorted(cumulative, rank, side='right'))
+                if mins[k] == maxs[k]:
+                    values[rank] = float(mins[k])
+                    continue
+                key = (float(mins[k]), float(maxs[k]),
+                       int(cumulative[k] - counts[k]))
+                refined.setdefault(key, ([], int(counts[k])))[0].append(rank)
+        intervals = refined
+        passes += 1
+    return values
+
 
-    rddSortedWithIndex = (rdd.sortBy(lambda x: x).zipWithIndex().map(
-        lambda x: (x[1], x[0])).cache())
+def interval_histograms(rdd, bounds, buckets):
+    """Per interval (lo, hi, _), count, min and max of the values falling in
+    each of `buckets` equal-width buckets, in one pass."""
+    def partition_histograms(iterator):
+        x = np.fromiter(iterator, dtype=float)
+        res = []
+        for a, b, _ in bounds:
+            v = x[(x >= a) & (x <= b)]
+            index = np.minimum(
+                ((v - a) * (buckets / (b - a))).astype(np.int64), buckets - 1)
+            counts = np.bincount(index, minlength=buckets)
+            mins = np.full(buckets, np.inf)
+            maxs = np.full(buckets, -np.inf)
+            np.minimum.at(mins, index, v)
+            np.maximum.at(maxs, index, v)
+            res.append((counts, mins, maxs))
+        yield res
 
-    n = rddSortedWithIndex.count()
-    h = (n - 1) * p
+    def merge(left, right):
+        return [(c1 + c2, np.minimum(lo1, lo2), np.maximum(hi1, hi2))
+                for (c1, lo1, hi1), (c2, lo2, hi2) in zip(left, right)]
 
-    rddX, rddXPlusOne = (rddSortedWithIndex.lookup(x)[0][0]
-                         for x in int(np.floor(h)) + np.array([0, 1]))
-    return rddX + (h - np.floor(h)) * (rddXPlusOne - rddX)
+    return rdd.mapPartitions(partition_histograms).treeReduce(merge)
 
 
 def test_deco(f):
@@ -210,25 +1067,1310 @@ class PA2Test(object):
             format(at_least, total, correct)
 
 
-def spark_init(pid):
-    spark = SparkSession.builder.master("spark://spark-master:7077")\
-        .config("spark.dynamicAllocation.enabled", 'false')\
-        .config("spark.sql.crossJoin.enabled", "true")\
-        .config("spark.memory.fraction", "0.90")\
-        .config("spark.executor.memory", "18G")\
-        .config("spark.driver.memory", "3G")\
-        .config("spark.driver.extraLibraryPath", "/opt/hadoop/lib/native")\
-        .config("spark.driver.port", "20002")\
-        .config("spark.blockManager.port", "50002")\
-        .config("spark.fileserver.port", "6002")\
-        .config("spark.broadcast.port", "60003")\
-        .config("spark.replClassServer.port", "60004")\
-        .config("spark.port.maxRetries", "1")\
-        .appName(pid)\
-        .getOrCreate()
+def executor_count(sc, wait=10.0):
+    """Executors the application runs with: spark.executor.instances, or
+    spark.cores.max / spark.executor.cores. Without either, those registered
+    once their number has held for a second, waiting up to wait seconds for
+    the first ones (right after startup only the driver is listed)."""
+    if sc.master.startswith('local'):
+        return 1
+    conf = sc.getConf()
+    if conf.get('spark.executor.instances', None):
+        return int(conf.get('spark.executor.instances'))
+    cores_max = conf.get('spark.cores.max', None)
+    cores = conf.get('spark.executor.cores', None)
+    if cores_max and cores:
+        return max(1, int(cores_max) // int(cores))
+    return registered_executors(sc, wait)
+
+
+def registered_executors(sc, wait=10.0):
+    """Executors registered once their number has held for a second,
+    waiting up to wait seconds for the first ones."""
+    tracker = sc._jsc.sc().statusTracker()
+    deadline = time.time() + wait
+    count, since = 0, time.time()
+    while time.time() < deadline:
+        # the driver is listed alongside the executors
+        registered = max(0, len(tracker.getExecutorInfos()) - 1)
+        if registered != count:
+            count, since = registered, time.time()
+        elif count and time.time() - since >= 1.0:
+            break
+        time.sleep(0.2)
+    return max(1, count)
+
+
+def total_cores(sc):
+    """Cores the application's tasks run on: spark.cores.max, or executors
+    times spark.executor.cores; without those, the default parallelism once
+    the executors have registered (before, it only counts the driver's)."""
+    if sc.master.startswith('local'):
+        return sc.defaultParallelism
+    conf = sc.getConf()
+    if conf.get('spark.cores.max', None):
+        return int(conf.get('spark.cores.max'))
+    cores = conf.get('spark.executor.cores', None)
+    if cores:
+        return executor_count(sc) * int(cores)
+    registered_executors(sc)
+    return sc.defaultParallelism
+
+
+# Settings shared by every profile: Kryo for the JVM side, Arrow for
+# toPandas/createDataFrame (both the 2.x and 3.x keys), adaptive execution.
+SPARK_COMMON = {
+    "spark.serializer": "org.apache.spark.serializer.KryoSerializer",
+    "spark.kryoserializer.buffer.max": "512m",
+    "spark.sql.execution.arrow.enabled": "true",
+    "spark.sql.execution.arrow.pyspark.enabled": "true",
+    "spark.sql.adaptive.enabled": "true",
+    "spark.sql.adaptive.coalescePartitions.enabled": "true",
+    "spark.sql.crossJoin.enabled": "true",
+    "spark.dynamicAllocation.enabled": "false",
+}
+SPARK_PROFILES = {
+    'cluster': dict(SPARK_COMMON, **{
+        "master": "spark://spark-master:7077",
+        "spark.memory.fraction": "0.90",
+        "spark.executor.memory": "18G",
+        "spark.driver.memory": "3G",
+        "spark.driver.extraLibraryPath": "/opt/hadoop/lib/native",
+        "spark.driver.port": "20002",
+        "spark.blockManager.port": "50002",
+        "spark.fileserver.port": "6002",
+        "spark.broadcast.port": "60003",
+        "spark.replClassServer.port": "60004",
+        "spark.port.maxRetries": "1",
+    }),
+    'local': dict(SPARK_COMMON, **{
+        "master": "local[*]",
+        "spark.driver.memory": "4G",
+        "spark.memory.fraction": "0.75",
+    }),
+    # local, with nothing running beside the measured jobs
+    'benchmark': dict(SPARK_COMMON, **{
+        "master": "local[*]",
+        "spark.driver.memory": "4G",
+        "spark.memory.fraction": "0.75",
+        "spark.ui.enabled": "false",
+        "spark.eventLog.enabled": "false",
+        "spark.sql.ui.retainedExecutions": "1",
+    }),
+}
+# Keys set by tune_memory and tune_sql.
+TUNED_KEYS = ["spark.memory.fraction", "spark.sql.shuffle.partitions",
+              "spark.sql.autoBroadcastJoinThreshold",
+              "spark.sql.adaptive.advisoryPartitionSizeInBytes"]
+
+
+def input_bytes(path_dict):
+    """Total size of the inputs, or None if one of them cannot be
+    fingerprinted (e.g. it is not on a local or mounted file system)."""
+    total = 0
+    for path in path_dict.values():
+        fingerprint = path and path_fingerprint(path)
+        if not fingerprint:
+            return None
+        total += fingerprint['size']
+    return total
+
+
+def tune_memory(config, size):
+    """Unified memory fraction for inputs of size bytes: when twice the
+    inputs fit in the heap, caching them all leaves room, so execution and
+    storage get most of it; otherwise more stays with user memory for the
+    ML tasks' models and broadcasts."""
+    memory = parse_bytes(config.get("spark.executor.memory") or
+                         config.get("spark.driver.memory", "1G"))
+    fraction = "0.90" if 2 * size < memory else "0.75"
+    return {"spark.memory.fraction": fraction}
+
+
+def tune_sql(config, size, cores, partition_bytes=128 << 20):
+    """Shuffle partitions of about partition_bytes of input each, a multiple
+    of the cores and at least two waves; a broadcast threshold of 1/64 of
+    the heap, between 10 MB and 256 MB."""
+    memory = parse_bytes(config.get("spark.executor.memory") or
+                         config.get("spark.driver.memory", "1G"))
+    partitions = max(2 * cores, -(-size // partition_bytes))
+    partitions = -(-partitions // cores) * cores
+    threshold = min(max(memory // 64, 10 << 20), 256 << 20)
+    return {
+        "spark.sql.shuffle.partitions": str(partitions),
+        "spark.sql.autoBroadcastJoinThreshold": str(threshold),
+        "spark.sql.adaptive.advisoryPartitionSizeInBytes": str(partition_bytes)
+    }
+
+
+def pinned_threads(sc):
+    """Whether every Python thread drives its own JVM thread, so that local
+    properties (scheduler pool, job group) set in one thread stay there.
+    Needs PySpark 3 with PYSPARK_PIN_THREAD, which spark_init sets."""
+    try:
+        from py4j.clientserver import ClientServer
+    except ImportError:
+        return False
+    return isinstance(sc._gateway, ClientServer)
+
+
+def spark_init(pid, master=None, profile='cluster', path_dict=None,
+               auto_tune=False):
+    """SparkSession configured by the named SPARK_PROFILES entry; master
+    overrides the profile's. With auto_tune, the memory fraction, shuffle
+    partitions and broadcast threshold are derived from the sizes of the
+    path_dict inputs and the cores available (see tune_memory, tune_sql);
+    if the input sizes are unknown, the profile is left as it is."""
+    scheduler_file = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'fairscheduler.xml')
+    # read when the gateway starts; PySpark 2.4 ignores it
+    os.environ.setdefault('PYSPARK_PIN_THREAD', 'true')
+    config = dict(SPARK_PROFILES[profile])
+    profile_master = config.pop('master')
+    master = master or profile_master
+    config["spark.scheduler.mode"] = "FAIR"
+    config["spark.scheduler.allocation.file"] = scheduler_file
+    size = input_bytes(path_dict) if auto_tune and path_dict else None
+    if auto_tune and not size:
+        print ("Input sizes unknown, not tuning the Spark configuration")
+        size = None
+    if size is not None:
+        config.update(tune_memory(config, size))
+    builder = SparkSession.builder.master(master)
+    for key, value in config.items():
+        builder = builder.config(key, value)
+    spark = builder.appName(pid).getOrCreate()
+    if size is not None:
+        cores = total_cores(spark.sparkContext)
+        for key, value in tune_sql(config, size, cores).items():
+            spark.conf.set(key, value)
     return spark
 
 
+def spark_config(spark):
+    """The profile and tuned settings in effect, with the master."""
+    conf = spark.sparkContext.getConf()
+    keys = set(TUNED_KEYS)
+    for config in SPARK_PROFILES.values():
+        keys.update(k for k in config if k != 'master')
+    applied = {'master': spark.sparkContext.master}
+    for key in sorted(keys):
+        value = spark.conf.get(key, None) or conf.get(key, None)
+        if value is not None:
+            applied[key] = value
+    return applied
+
+
+# Storage levels as the JVM sees them; pyspark.StorageLevel only exports the
+# serialized variants since Python objects are always pickled.
+STORAGE_LEVELS = {
+    'MEMORY_ONLY': StorageLevel(False, True, False, True),
+    'MEMORY_ONLY_SER': StorageLevel(False, True, False, False),
+    'MEMORY_AND_DISK': StorageLevel(True, True, False, True),
+    'OFF_HEAP': StorageLevel(True, True, True, False)
+}
+
+
+class PersistencePlanner(object):
+    """Decide which inputs to persist, at which storage level, and when to
+    evict them, for a given sequence of tasks.
+
+    Only inputs read by more than one task are persisted; everything else is
+    cheaper to rescan. Inputs are placed greedily in order of first use
+    against the storage memory left over by inputs whose lifetimes overlap:
+    deserialized in memory if they fit, serialized if that fits, off-heap if
+    configured, and memory-and-disk otherwise so they spill rather than get
+    recomputed. Each input is evicted after the last task that reads it.
+    With lookahead > 0 lifetimes start that many tasks early, leaving room for
+    inputs warmed by a Prefetcher while the preceding tasks still run.
+
+    Sizes are estimated from the on-disk size of the inputs until they have
+    been cached once; measured sizes are kept in output_root and reused by
+    later runs.
+    """
+    # in-memory size per on-disk byte, by source format
+    EXPANSION = {'csv': 1.0, 'parquet': 3.0}
+    SER_RATIO = 0.8
+    RESERVED = 300 << 20
+    SIZES_FILE = 'persistence_sizes.json'
+
+    def __init__(self, data_io, task_names, budget=None, off_heap_budget=None,
+                 lookahead=0):
+        self.data_io = data_io
+        self.lookahead = lookahead
+        self.lock = threading.RLock()
+        self.spark = data_io.spark
+        self.task_names = list(task_names)
+        self.columns = data_io.required_columns(self.task_names)
+        self.users = {}
+        for task_name in self.task_names:
+            for name in TASK_INPUTS[task_name]:
+                self.users.setdefault(name, []).append(task_name)
+        self.remaining = {name: set(tasks) for name, tasks in self.users.items()}
+        if budget is None or off_heap_budget is None:
+            on_heap, off_heap = self.storage_budget()
+            budget = on_heap if budget is None else budget
+            off_heap_budget = off_heap if off_heap_budget is None \
+                else off_heap_budget
+        self.budget = budget
+        self.off_heap_budget = off_heap_budget
+        self.sizes = self.load_sizes()
+        self.persisted = {}
+        self.rdd_ids = {}
+        self.snapshots = {}
+        self.decisions = {}
+        self.plan()
+
+    def executor_count(self):
+        return executor_count(self.spark.sparkContext)
+
+    def storage_budget(self):
+        """Storage memory Spark will not evict for execution, cluster-wide:
+        (heap - reserved) * memory.fraction * memory.storageFraction."""
+        conf = self.spark.sparkContext.getConf()
+        if self.spark.sparkContext.master.startswith('local'):
+            heap = parse_bytes(conf.get('spark.driver.memory', '1g'))
+        else:
+            heap = parse_bytes(conf.get('spark.executor.memory', '1g'))
+        fraction = float(conf.get('spark.memory.fraction', '0.6'))
+        storage_fraction = float(conf.get('spark.memory.storageFraction', '0.5'))
+        executors = self.executor_count()
+        on_heap = max(0, heap - self.RESERVED) * fraction * storage_fraction
+        off_heap = 0
+        if conf.get('spark.memory.offHeap.enabled', 'false') == 'true':
+            off_heap = parse_bytes(conf.get('spark.memory.offHeap.size', '0'))
+        return on_heap * executors, off_heap * executors
+
+    def size_key(self, name):
+        return digest({'source': path_fingerprint(self.data_io.path_dict[name]),
+                       'columns': self.columns.get(name)})
+
+    def load_sizes(self):
+        path = os.path.join(self.data_io.output_root, self.SIZES_FILE)
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def store_sizes(self):
+        path = os.path.join(self.data_io.output_root, self.SIZES_FILE)
+        try:
+            os.makedirs(self.data_io.output_root, exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump(self.sizes, f)
+        except (IOError, OSError):
+            pass
+
+    def estimate(self, name):
+        measured = self.sizes.get(self.size_key(name))
+        if measured is not None:
+            return measured
+        path = self.data_io.path_dict[name]
+        fingerprint = path_fingerprint(path)
+        if fingerprint is None:
+            return None
+        kind = 'parquet' if name in ['ml_features_train', 'ml_features_test'] \
+            else 'csv'
+        size = fingerprint['size'] * self.EXPANSION[kind]
+        columns = self.columns.get(name)
+        if columns is not None and name in self.data_io.schema:
+            size *= float(len(columns)) / len(self.data_io.schema[name].fields)
+        return int(size)
+
+    def lifetime(self, name):
+        tasks = self.users[name]
+        return (max(0, self.task_names.index(tasks[0]) - self.lookahead),
+                self.task_names.index(tasks[-1]))
+
+    def plan(self):
+        decisions = {}
+        for name in sorted(self.users, key=lambda n: self.lifetime(n)[0]):
+            first, last = self.lifetime(name)
+            size = self.estimate(name)
+            decision = {'level': None, 'size': size,
+                        'first': self.users[name][0],
+                        'evict_after': self.task_names[last]}
+            decisions[name] = decision
+            if name in self.persisted:
+                decision['level'] = self.persisted[name]
+                continue
+            if len(self.users[name]) < 2:
+                continue
+            on_heap, off_heap = 0, 0
+            for other, d in decisions.items():
+                if other == name or d['level'] is None or d['size'] is None:
+                    continue
+                o_first, o_last = self.lifetime(other)
+                if o_last < first or o_first > last:
+                    continue
+                if d['level'] == 'OFF_HEAP':
+                    off_heap += d['size'] * self.SER_RATIO
+                elif d['level'] == 'MEMORY_ONLY_SER':
+                    on_heap += d['size'] * self.SER_RATIO
+                else:
+                    on_heap += d['size']
+            free, free_off_heap = self.budget - on_heap, \
+                self.off_heap_budget - off_heap
+            if size is not None and size <= free:
+                decision['level'] = 'MEMORY_ONLY'
+            elif size is not None and size * self.SER_RATIO <= free:
+                decision['level'] = 'MEMORY_ONLY_SER'
+            elif size is not None and size * self.SER_RATIO <= free_off_heap:
+                decision['level'] = 'OFF_HEAP'
+            else:
+                decision['level'] = 'MEMORY_AND_DISK'
+        self.decisions = decisions
+        return decisions
+
+    def storage_info(self):
+        sc = self.spark.sparkContext
+        return {info.id(): (info.name(), info.memSize(), info.diskSize())
+                for info in sc._jsc.sc().getRDDStorageInfo()}
+
+    def markers(self, name):
+        """File names that appear in the plan string Spark uses to name the
+        cached RDD of an input."""
+        path = self.data_io.path_dict[name]
+        markers = [os.path.basename(path.rstrip('/'))]
+        if self.data_io.conversion_root and name in self.data_io.schema:
+            converted = self.data_io.converted_path(name, path)
+            if converted:
+                markers.append(os.path.basename(converted))
+        return markers
+
+    def persist(self, name, data_dict):
+        """Persist name at its planned level unless it already is. Returns
+        whether the input is persisted."""
+        with self.lock:
+            level = self.decisions.get(name, {}).get('level')
+            if level is None:
+                return False
+            if name in self.persisted:
+                return True
+            if self.data_io.input_format == 'koalas':
+                print('persistence planning has no effect on Koalas')
+                return False
+            self.snapshots[name] = set(self.storage_info())
+            data_dict[name] = self.data_io.narrow(
+                data_dict[name], self.columns.get(name)
+            ).persist(STORAGE_LEVELS[level])
+            self.persisted[name] = level
+            self.rdd_ids[name] = None
+            return True
+
+    def measure(self, name):
+        """Attribute the RDD blocks cached since name was persisted to it and
+        record its size."""
+        with self.lock:
+            if self.rdd_ids.get(name, []) is not None:
+                return
+            info = self.storage_info()
+            created = [i for i in info if i not in self.snapshots.pop(name)]
+            markers = self.markers(name)
+            ids = [i for i in created
+                   if any(m in info[i][0] for m in markers)]
+            pending = [n for n, i in self.rdd_ids.items() if i is None]
+            if not ids and len(pending) == 1:
+                ids = created
+            self.rdd_ids[name] = ids
+            size = sum(info[i][1] + info[i][2] for i in ids)
+            if size:
+                self.sizes[self.size_key(name)] = size
+                self.store_sizes()
+                self.plan()
+
+    def before(self, task_name, data_dict):
+        """Persist the planned inputs of task_name that are not yet cached."""
+        for name in TASK_INPUTS[task_name]:
+            self.persist(name, data_dict)
+
+    def after(self, task_name, data_dict):
+        """Record the footprint of inputs first cached by task_name and evict
+        those no remaining task reads."""
+        for name in TASK_INPUTS[task_name]:
+            self.measure(name)
+        with self.lock:
+            for name in TASK_INPUTS[task_name]:
+                if name not in self.remaining:
+                    continue
+                self.remaining[name].discard(task_name)
+                if not self.remaining[name] and name in self.persisted:
+                    data_dict[name].unpersist()
+                    del self.persisted[name]
+                    print ("Evicted {} after {}".format(name, task_name))
+
+    def footprint(self):
+        """In-memory and on-disk bytes of each currently cached input."""
+        info = self.storage_info()
+        footprint = {}
+        for name, level in list(self.persisted.items()):
+            ids = [i for i in (self.rdd_ids.get(name) or []) if i in info]
+            footprint[name] = {
+                'level': level,
+                'mem_bytes': sum(info[i][1] for i in ids),
+                'disk_bytes': sum(info[i][2] for i in ids)
+            }
+        return footprint
+
+    def report(self):
+        print ("Persistence plan (storage budget {:.1f} GB):".format(
+            self.budget / float(1 << 30)))
+        for name, d in self.decisions.items():
+            print ("  {}: {} (est. {} bytes, {} -> {})".format(
+                name, d['level'] or 'not persisted', d['size'],
+                d['first'], d['evict_after']))
+        for name, f in self.footprint().items():
+            print ("  cached {}: {} in memory, {} on disk ({})".format(
+                name, f['mem_bytes'], f['disk_bytes'], f['level']))
+
+
+class Prefetcher(object):
+    """Load, persist and materialize the inputs of upcoming tasks on a
+    background thread.
+
+    On pinned threads (see pinned_threads) prefetch jobs run in their own
+    FAIR scheduler pool (see fairscheduler.xml), weighted below the default
+    pool the tasks run in, so the scan overlaps the tail of the current part
+    without starving it. Pools are thread-local properties that would leak
+    onto the task's jobs on unpinned threads, so there the prefetch shares
+    the default pool evenly with the task, and intervals (see TaskIntervals)
+    attribute its jobs to the 'prefetch' group.
+    """
+    POOL = 'prefetch'
+
+    def __init__(self, data_io, planner, data_dict, intervals=None):
+        self.data_io = data_io
+        self.planner = planner
+        self.data_dict = data_dict
+        self.intervals = intervals
+        self.thread = None
+        self.names = []
+
+    def start(self, task_names):
+        names = []
+        for task_name in task_names:
+            names += [n for n in TASK_INPUTS[task_name] if n not in names]
+        self.names = names
+        self.thread = Thread(target=self.run, args=(names,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, names):
+        sc = self.data_io.spark.sparkContext
+        try:
+            if self.intervals is not None:
+                self.intervals.begin(self.POOL)
+            else:
+                # not the job group of the task that started the prefetch
+                sc.setJobGroup(self.POOL, 'prefetch')
+                sc.setLocalProperty('spark.scheduler.pool', self.POOL)
+            for name in names:
+                try:
+                    if self.planner.persist(name, self.data_dict):
+                        print ("Prefetching {} ...".format(name))
+                        self.data_dict[name].count()
+                        self.planner.measure(name)
+                except Exception as e:
+                    # the task will load the input itself
+                    print ("Prefetching {} failed: {}".format(name, e))
+        finally:
+            if self.intervals is not None:
+                self.intervals.end(self.POOL)
+            else:
+                sc.setLocalProperty('spark.scheduler.pool', None)
+                sc.setLocalProperty('spark.jobGroup.id', None)
+                sc.setLocalProperty('spark.job.description', None)
+
+    def wait(self, task_name):
+        """Block until the prefetch of task_name's inputs has finished."""
+        if self.thread is not None and \
+                any(n in self.names for n in TASK_INPUTS[task_name]):
+            self.thread.join()
+            self.thread = None
+
+
+class TaskIntervals(object):
+    """Wall-clock intervals in which tasks ran, for attributing Spark jobs to
+    tasks without job groups. On unpinned PySpark (2.4) a local property is
+    set on whichever JVM thread serves the call, and py4j callbacks share
+    those threads, so a job can carry another task's group or none. A job
+    started at time t instead belongs to the tasks running at t; tasks that
+    overlap share it as a 'task_a+task_b' group, like fused tasks."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.intervals = []
+
+    def begin(self, name):
+        with self.lock:
+            self.intervals.append([name, time.time(), None])
+
+    def end(self, name):
+        now = time.time()
+        with self.lock:
+            for interval in reversed(self.intervals):
+                if interval[0] == name and interval[2] is None:
+                    interval[2] = now
+                    break
+
+    def group(self, t):
+        """Group of the tasks running at time t (seconds), None if none."""
+        with self.lock:
+            names = set()
+            for name, begin, end in self.intervals:
+                if begin <= t and (end is None or t <= end):
+                    names.update(name.split('+'))
+        return '+'.join(sorted(names)) or None
+
+
+class TaskMetricsListener(object):
+    """SparkListener, called back through py4j, that sums the metrics of the
+    completed stages of each job group. Fused tasks share a group named
+    'task_a+task_b'; task_metrics splits it evenly between them, as the
+    executor does with their time. With intervals (see TaskIntervals) jobs
+    are attributed by their start time instead of their job group."""
+    METRICS = ['executor_run_time_ms', 'gc_time_ms', 'shuffle_read_bytes',
+               'shuffle_write_bytes', 'memory_spill_bytes', 'disk_spill_bytes',
+               'input_bytes', 'peak_execution_memory']
+
+    def __init__(self, intervals=None):
+        self.lock = threading.Lock()
+        self.stage_groups = {}
+        self.metrics = {}
+        self.intervals = intervals
+
+    @classmethod
+    def install(cls, sc, intervals=None):
+        from pyspark.streaming import StreamingContext
+        # starts the py4j callback server the JVM calls the listener through
+        StreamingContext._ensure_initialized()
+        listener = cls(intervals)
+        sc._jsc.sc().addSparkListener(listener)
+        return listener
+
+    @staticmethod
+    def drain(sc, timeout_ms=10000):
+        """Wait for the listener bus to deliver the events posted so far."""
+        try:
+            sc._jsc.sc().listenerBus().waitUntilEmpty(timeout_ms)
+        except Exception:
+            pass
+
+    def reset(self):
+        with self.lock:
+            self.metrics = {}
+
+    def group(self, name):
+        if name not in self.metrics:
+            self.metrics[name] = dict.fromkeys(['jobs', 'stages'] +
+                                               self.METRICS, 0)
+        return self.metrics[name]
+
+    def onJobStart(self, event):
+        if self.intervals is not None:
+            name = self.intervals.group(event.time() / 1000.0)
+        else:
+            properties = event.properties()
+            name = properties and properties.getProperty('spark.jobGroup.id')
+        if not name:
+            return
+        stage_ids = event.stageIds()
+        with self.lock:
+            self.group(name)['jobs'] += 1
+            for i in range(stage_ids.size()):
+                self.stage_groups[stage_ids.apply(i)] = name
+
+    def onStageCompleted(self, event):
+        info = event.stageInfo()
+        with self.lock:
+            name = self.stage_groups.pop(info.stageId(), None)
+        metrics = info.taskMetrics()
+        if name is None or metrics is None:
+            return
+        values = {
+            'executor_run_time_ms': metrics.executorRunTime(),
+            'gc_time_ms': metrics.jvmGCTime(),
+            'shuffle_read_bytes':
+                metrics.shuffleReadMetrics().totalBytesRead(),
+            'shuffle_write_bytes':
+                metrics.shuffleWriteMetrics().bytesWritten(),
+            'memory_spill_bytes': metrics.memoryBytesSpilled(),
+            'disk_spill_bytes': metrics.diskBytesSpilled(),
+            'input_bytes': metrics.inputMetrics().bytesRead(),
+            'peak_execution_memory': metrics.peakExecutionMemory()
+        }
+        with self.lock:
+            group = self.group(name)
+            group['stages'] += 1
+            for metric, value in values.items():
+                if metric == 'peak_execution_memory':
+                    group[metric] = max(group[metric], value)
+                else:
+                    group[metric] += value
+
+    def __getattr__(self, name):
+        # the remaining SparkListenerInterface callbacks
+        if name.startswith('on'):
+            return lambda *args: None
+        raise AttributeError(name)
+
+    def task_metrics(self, task_name):
+        """Metrics of task_name's job group(s), zero if it ran no jobs."""
+        totals = dict.fromkeys(['jobs', 'stages'] + self.METRICS, 0)
+        with self.lock:
+            for name, group in self.metrics.items():
+                members = name.split('+')
+                if task_name not in members:
+                    continue
+                for metric, value in group.items():
+                    if metric == 'peak_execution_memory':
+                        totals[metric] = max(totals[metric], value)
+                    else:
+                        totals[metric] += value / float(len(members)) \
+                            if len(members) > 1 else value
+        return totals
+
+    class Java:
+        implements = ['org.apache.spark.scheduler.SparkListenerInterface']
+
+
+def normalize_plan(plan):
+    """Plan text with what changes from run to run for the same query
+    (expression and exchange ids, codegen stage and operator numbers, file
+    locations) replaced by placeholders."""
+    plan = re.sub(r'#\d+L?', '#', plan)
+    plan = re.sub(r'\*\(\d+\)', '*', plan)
+    plan = re.sub(r'^\(\d+\)', '(n)', plan, flags=re.M)
+    plan = re.sub(r' \(\d+\)$', ' (n)', plan, flags=re.M)
+    plan = re.sub(r'(plan_id|id)=#?\d+', r'\1=n', plan)
+    plan = re.sub(r'(file|hdfs|s3a?):[^\s,\]]+', r'\1:...', plan)
+    return '\n'.join(line.rstrip() for line in plan.splitlines())
+
+
+def plan_operators(plan):
+    """Count of each physical operator in the tree parts of a plan: the
+    lines after a '== ... ==' header up to the first blank line, which in
+    formatted mode starts the per-operator details. Of an adaptive plan only
+    the Final Plan counts; its Initial Plan is skipped."""
+    operators = Counter()
+    in_tree = False
+    for line in plan.splitlines():
+        if line.startswith('=='):
+            in_tree = True
+        elif not line.strip():
+            in_tree = False
+        elif '== Initial Plan ==' in line:
+            in_tree = False
+        elif '== Final Plan ==' in line:
+            in_tree = True
+        elif in_tree:
+            match = re.match(r'^[\s:|+\-*]*([A-Z][A-Za-z]+)', line)
+            if match:
+                operators[match.group(1)] += 1
+    return operators
+
+
+class PlanCapture(object):
+    """QueryExecutionListener, called back through py4j, that keeps the
+    executed plan of every successful query, per job group. On Spark 3 the
+    plan is explain's formatted mode (with AQE, the final adaptive plan);
+    older versions give the executed plan's tree string. Queries outside a
+    job group go to current, the task the executor started last.
+
+    Spark 3 calls the listener from the listener bus, where the job group
+    of the query's thread is not set. PlanCapture is therefore also a
+    SparkListener that maps each SQL execution id to the job group its jobs
+    started in, and attributes a plan by its execution id. With intervals
+    (see TaskIntervals) groups come from the time jobs and queries ran."""
+
+    def __init__(self, intervals=None):
+        self.lock = threading.Lock()
+        self.plans = {}
+        self.execution_groups = {}
+        self.current = None
+        self.intervals = intervals
+
+    @classmethod
+    def install(cls, spark, intervals=None):
+        from pyspark.streaming import StreamingContext
+        StreamingContext._ensure_initialized()
+        capture = cls(intervals)
+        capture.jvm = spark.sparkContext._jvm
+        spark.sparkContext._jsc.sc().addSparkListener(capture)
+        spark._jsparkSession.listenerManager().register(capture)
+        return capture
+
+    def onJobStart(self, event):
+        properties = event.properties()
+        if not properties:
+            return
+        execution_id = properties.getProperty('spark.sql.execution.id')
+        if self.intervals is not None:
+            group = self.intervals.group(event.time() / 1000.0)
+        else:
+            group = properties.getProperty('spark.jobGroup.id')
+        if execution_id and group:
+            with self.lock:
+                self.execution_groups[execution_id] = group
+
+    def group(self, qe, duration_ns):
+        """Job group of the query: the one its jobs started in, or (Spark
+        2, which calls the listener on the query's thread as it ends) the
+        tasks running halfway through it, or the caller's job group."""
+        try:
+            with self.lock:
+                group = self.execution_groups.pop(str(qe.id()), None)
+            if group:
+                return group
+        except Exception:
+            pass
+        if self.intervals is not None:
+            return self.intervals.group(time.time() - duration_ns / 2e9)
+        return qe.sparkSession().sparkContext().getLocalProperty(
+            'spark.jobGroup.id')
+
+    def explain(self, qe):
+        try:
+            mode = self.jvm.org.apache.spark.sql.execution.ExplainMode \
+                .fromString('formatted')
+            return qe.explainString(mode)
+        except Exception:
+            return qe.executedPlan().treeString()
+
+    def onSuccess(self, func_name, qe, duration_ns):
+        try:
+            group = self.group(qe, duration_ns)
+            plan = normalize_plan(self.explain(qe))
+        except Exception as e:
+            print ("Plan capture failed: {}".format(e))
+            return
+        with self.lock:
+            self.plans.setdefault(group or self.current, []).append(
+                '== {} ==\n{}'.format(func_name, plan))
+
+    def onFailure(self, func_name, qe, exception):
+        try:
+            with self.lock:
+                self.execution_groups.pop(str(qe.id()), None)
+        except Exception:
+            pass
+
+    def __getattr__(self, name):
+        # the remaining SparkListenerInterface callbacks
+        if name.startswith('on'):
+            return lambda *args: None
+        raise AttributeError(name)
+
+    def take(self, group):
+        """Plans captured for group since the last take."""
+        with self.lock:
+            return self.plans.pop(group, [])
+
+    class Java:
+        implements = ['org.apache.spark.sql.util.QueryExecutionListener',
+                      'org.apache.spark.scheduler.SparkListenerInterface']
+
+
+class PlanHistory(object):
+    """Captured plans and times of the tasks, one directory per run under
+    root, each compared with the run before it. A task's plan changed
+    structurally when its physical operators differ in kind or number,
+    e.g. a BroadcastHashJoin became a SortMergeJoin or an Exchange was
+    added."""
+
+    def __init__(self, root):
+        self.root = local_path(root)
+        self.run_id = time.strftime('%Y%m%d-%H%M%S')
+
+    def runs(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(r for r in os.listdir(self.root)
+                      if os.path.exists(os.path.join(self.root, r, 'times.json')))
+
+    def load(self, run_id):
+        path = os.path.join(self.root, run_id)
+        with open(os.path.join(path, 'times.json')) as f:
+            times = json.load(f)
+        plans = {}
+        for task_name in times:
+            try:
+                with open(os.path.join(path, task_name + '.txt')) as f:
+                    plans[task_name] = f.read()
+            except IOError:
+                plans[task_name] = ''
+        return plans, times
+
+    def store(self, plans, times):
+        path = os.path.join(self.root, self.run_id)
+        os.makedirs(path, exist_ok=True)
+        for task_name, text in plans.items():
+            with open(os.path.join(path, task_name + '.txt'), 'w') as f:
+                f.write(text)
+        with open(os.path.join(path, 'times.json'), 'w') as f:
+            json.dump(times, f, indent=1)
+
+    def compare(self, plans, times):
+        """Store this run and report, per task whose plan changed
+        structurally since the previous run, the operator changes, the
+        time change and the plan diff."""
+        previous = [r for r in self.runs() if r < self.run_id]
+        self.store(plans, times)
+        if not previous:
+            return {}
+        old_plans, old_times = self.load(previous[-1])
+        changes = {}
+        for task_name, text in plans.items():
+            if task_name not in old_plans:
+                continue
+            delta = plan_operators(text)
+            delta.subtract(plan_operators(old_plans[task_name]))
+            operators = ['{:+d} {}'.format(n, op)
+                         for op, n in sorted(delta.items()) if n]
+            if not operators:
+                continue
+            changes[task_name] = {
+                'operators': operators,
+                'time_sec': [old_times.get(task_name), times.get(task_name)],
+                'diff': ''.join(difflib.unified_diff(
+                    old_plans[task_name].splitlines(True),
+                    text.splitlines(True),
+                    previous[-1], self.run_id))
+            }
+            print ("{}: plan changed since {} ({}), time {} -> {} sec".format(
+                task_name, previous[-1], ', '.join(operators),
+                old_times.get(task_name), times.get(task_name)))
+            print (changes[task_name]['diff'])
+        with open(os.path.join(self.root, self.run_id, 'changes.json'),
+                  'w') as f:
+            json.dump(changes, f, indent=1)
+        return changes
+
+
+def code_references(code):
+    """Global names used by code and the functions nested in it."""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= code_references(const)
+    return names
+
+
+def source_digest(func, modules=None):
+    """Hash of the source of func and of every function and class of
+    modules (func's own and this one by default) it refers to, directly or
+    through them. For closures, the plain values they capture (column names,
+    constants) are part of the hash too."""
+    modules = modules or {func.__module__, __name__}
+    sources = {}
+
+    def visit(obj):
+        name = obj.__module__ + '.' + obj.__qualname__
+        if name in sources:
+            return
+        try:
+            sources[name] = inspect.getsource(obj)
+        except (OSError, TypeError):
+            sources[name] = None
+            return
+        if inspect.isfunction(obj):
+            functions = [obj]
+        else:
+            functions = []
+            for f in vars(obj).values():
+                if isinstance(f, (staticmethod, classmethod)):
+                    f = f.__func__
+                if isinstance(f, property):
+                    functions += [g for g in (f.fget, f.fset, f.fdel) if g]
+                elif inspect.isfunction(f):
+                    functions.append(f)
+        for f in functions:
+            targets = [f.__globals__.get(ref)
+                       for ref in code_references(f.__code__)]
+            for cell in f.__closure__ or ():
+                try:
+                    value = cell.cell_contents
+                except ValueError:
+                    continue
+                if isinstance(value, (str, int, float, bool)):
+                    sources[name] += '\n' + repr(value)
+                targets.append(value)
+            for target in targets:
+                if (inspect.isfunction(target) or inspect.isclass(target)) \
+                        and target.__module__ in modules:
+                    visit(target)
+
+    visit(func)
+    return digest(sources, 32)
+
+
+class TaskMemo(object):
+    """On-disk store of task results, keyed on the fingerprints and schemas
+    of the task's inputs, the source of the task and of data_io's class with
+    the helpers it calls (see source_digest) and its other arguments. Holds
+    at most max_entries results and evicts the least recently used; an
+    entry's mtime is its last use. Only results that passed their tests are
+    stored."""
+
+    def __init__(self, root, max_entries=64):
+        self.root = local_path(root)
+        self.max_entries = max_entries
+
+    def key(self, data_io, task_name, task, arguments=()):
+        """Memo key of a run of task, or None if an input cannot be
+        fingerprinted."""
+        inputs = {}
+        for name, columns in TASK_INPUTS[task_name].items():
+            path = data_io.path_dict.get(name)
+            fingerprint = path and path_fingerprint(path)
+            if not fingerprint:
+                return None
+            schema = data_io.schema.get(name)
+            inputs[name] = dict(fingerprint, columns=columns,
+                                schema=schema and schema.json())
+        return digest({'task_name': task_name,
+                       'source': source_digest(task),
+                       'data_io': source_digest(type(data_io)),
+                       'inputs': inputs,
+                       'arguments': [repr(a) for a in arguments]}, 32)
+
+    def path(self, key):
+        return os.path.join(self.root, key + '.pkl')
+
+    def get(self, key):
+        """The stored res of key, or None."""
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                res = pickle.load(f)
+            os.utime(path)
+        except (IOError, OSError, pickle.UnpicklingError, EOFError):
+            return None
+        return res
+
+    def put(self, key, res):
+        os.makedirs(self.root, exist_ok=True)
+        path = self.path(key)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(res, f)
+        os.replace(tmp, path)
+        entries = sorted(
+            (os.path.join(self.root, f) for f in os.listdir(self.root)
+             if f.endswith('.pkl')), key=os.path.getmtime)
+        for stale in entries[:max(len(entries) - self.max_entries, 0)]:
+            os.remove(stale)
+
+
+def read_csv(spark, path, schema=None):
+    """Read PA2 CSV input(s); path may be a list. Without a schema the
+    column types are inferred."""
+    return spark.read.csv(
+        path,
+        schema=schema,
+        escape='"',
+        quote='"',
+        inferSchema=schema is None,
+        header=True
+    )
+
+
+def rollup_reviews(review_data, key='asin'):
+    """Per-key review statistics: count (non-null reviewerIDs), and the
+    count_overall, sum_overall and sumsq_overall of non-null ratings. All
+    four are sums, so rollups of disjoint review sets merge by adding.
+    key may be a list of grouping columns."""
+    overall = F.col('overall').cast(T.DoubleType())
+    return review_data.groupBy(key).agg(
+        F.count('reviewerID').alias('count'),
+        F.count(overall).alias('count_overall'),
+        F.sum(overall).alias('sum_overall'),
+        F.sum(overall * overall).alias('sumsq_overall'))
+
+
+def merge_rollups(rollups, key='asin'):
+    """Sum review rollups (of disjoint review sets) per key."""
+    columns = [key, 'count', 'count_overall', 'sum_overall', 'sumsq_overall']
+    merged = None
+    for rollup in rollups:
+        rollup = rollup.select(*columns)
+        merged = rollup if merged is None else merged.union(rollup)
+    return merged.groupBy(key).agg(
+        F.sum('count').alias('count'),
+        F.sum('count_overall').alias('count_overall'),
+        F.sum('sum_overall').alias('sum_overall'),
+        F.sum('sumsq_overall').alias('sumsq_overall'))
+
+
+class ReviewRollupStore(object):
+    """Per-asin review rollup kept on disk and extended one batch of review
+    files at a time, so the cost of an update follows the new reviews and
+    the number of asins, not the review history.
+
+    root holds numbered state-<version>.parquet directories and a manifest
+    listing the ingested files (with size and mtime) and the current
+    version. The manifest is replaced last and atomically, so an interrupted
+    update leaves the previous state in force.
+    """
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, spark, root, key='asin'):
+        self.spark = spark
+        self.root = local_path(root)
+        self.key = key
+
+    def manifest(self):
+        try:
+            with open(os.path.join(self.root, self.MANIFEST)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'version': 0, 'files': {}}
+
+    def state_path(self, version):
+        return os.path.join(self.root, 'state-{}.parquet'.format(version))
+
+    def state(self):
+        manifest = self.manifest()
+        if not manifest['version']:
+            return None
+        return self.spark.read.parquet(uri(self.state_path(manifest['version'])))
+
+    @staticmethod
+    def files(paths):
+        if isinstance(paths, str):
+            paths = [paths]
+        files = []
+        for path in paths:
+            path = local_path(path)
+            if os.path.isdir(path):
+                files += sorted(
+                    os.path.join(root, f)
+                    for root, _, fs in os.walk(path) for f in fs
+                    if not f.startswith(('.', '_')))
+            else:
+                files.append(path)
+        return [os.path.abspath(f) for f in files]
+
+    def pending(self, paths):
+        """Review files under paths that have not been ingested yet."""
+        ingested = self.manifest()['files']
+        pending = []
+        for f in self.files(paths):
+            fingerprint = path_fingerprint(f)
+            if f not in ingested:
+                pending.append(f)
+            elif ingested[f] != fingerprint:
+                raise ValueError(
+                    '{} changed after it was ingested; rebuild {}'.format(
+                        f, self.root))
+        return pending
+
+    def update(self, paths=None):
+        """Ingest the new review files under paths and return the state."""
+        pending = self.pending(paths) if paths else []
+        if pending:
+            print ("Ingesting {} review file(s) ...".format(len(pending)),
+                   end='')  # noqa
+            batch = read_csv(self.spark, [uri(f) for f in pending],
+                             PA2Data.review_schema)
+            self.merge(rollup_reviews(batch, self.key), pending)
+            print ("Done")
+        return self.state()
+
+    def merge(self, rollup, files=(), batch_id=None):
+        """Add a rollup of reviews to the state, recording files as
+        ingested. A streaming batch_id at or below the last merged one is a
+        replay and is skipped."""
+        manifest = self.manifest()
+        if batch_id is not None and batch_id <= manifest.get('batch_id', -1):
+            return
+        state = self.state()
+        rollups = [rollup] if state is None else [state, rollup]
+        rollup = merge_rollups(rollups, self.key)
+        version = manifest['version'] + 1
+        os.makedirs(self.root, exist_ok=True)
+        rollup.write.mode('overwrite').parquet(uri(self.state_path(version)))
+        for f in files:
+            manifest['files'][f] = path_fingerprint(f)
+        manifest['version'] = version
+        if batch_id is not None:
+            manifest['batch_id'] = batch_id
+        tmp = os.path.join(self.root, self.MANIFEST + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp, os.path.join(self.root, self.MANIFEST))
+        # keep the previous version for readers that started before the swap
+        for old in range(1, version - 1):
+            shutil.rmtree(self.state_path(old), ignore_errors=True)
+
+
+def json_value(value):
+    """value as Spark's JSON writer renders it when createDataFrame infers
+    its type: dict rows become structs with sorted fields, tuples structs
+    named _1, _2, ..., and null struct fields are left out. Raises TypeError
+    for values this does not cover."""
+    if value is None or isinstance(value, (bool, str)):
+        return value
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        value = float(value)
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return 'Infinity' if value > 0 else '-Infinity'
+        return value
+    if isinstance(value, Row):
+        return json_struct(zip(value.__fields__, value))
+    if isinstance(value, tuple):
+        return json_struct(
+            ('_' + str(i + 1), v) for i, v in enumerate(value))
+    if isinstance(value, Mapping):
+        # nested dicts are inferred as maps, which keep nulls and order
+        return dict((str(k), json_value(v)) for k, v in value.items())
+    if isinstance(value, (list, np.ndarray)):
+        return [json_value(v) for v in value]
+    raise TypeError('cannot write {} as JSON'.format(type(value).__name__))
+
+
+def json_struct(items):
+    return dict((k, json_value(v)) for k, v in items if v is not None)
+
+
+def json_rows(res):
+    """Lines of the JSON file Spark would write for the result rows."""
+    rows = [res] if isinstance(res, Mapping) else res
+    lines = []
+    for row in rows:
+        if isinstance(row, Mapping):
+            row = json_struct(sorted(row.items()))
+        else:
+            row = json_value(row)
+        lines.append(json.dumps(row, separators=(',', ':')))
+    return lines
+
+
+class ResultWriter(object):
+    """Writes small results on a background thread, in the layout of a
+    single-partition Spark JSON write (filename.json/part-00000-c000.json and
+    _SUCCESS). A new output is assembled in a temporary sibling directory
+    and an existing one gets a temporary part file; either is moved into
+    place with one os.replace, so readers never see it half written.
+    flush() waits for the queued writes and raises the first failure."""
+
+    PART = 'part-00000-c000.json'
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.errors = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        # daemon threads are still running when atexit handlers are called
+        atexit.register(self.flush)
+
+    def submit(self, path, lines):
+        self.queue.put((path, lines))
+
+    def run(self):
+        while True:
+            path, lines = self.queue.get()
+            try:
+                self.write(path, lines)
+            except Exception as e:
+                self.errors.append((path, e))
+            finally:
+                self.queue.task_done()
+
+    @classmethod
+    def write(cls, path, lines):
+        root = os.path.dirname(path)
+        os.makedirs(root, exist_ok=True)
+        token = uuid.uuid4()
+        if os.path.isdir(path):
+            # a directory cannot replace a non-empty one, so swap the part
+            # file; the leading dot hides it from readers until then
+            tmp = os.path.join(path, '.{}.tmp-{}'.format(cls.PART, token))
+            target = os.path.join(path, cls.PART)
+            part = tmp
+        else:
+            tmp = os.path.join(root, '.{}.tmp-{}'.format(
+                os.path.basename(path), token))
+            target = path
+            os.makedirs(tmp)
+            part = os.path.join(tmp, cls.PART)
+            open(os.path.join(tmp, '_SUCCESS'), 'w').close()
+        with open(part, 'w') as f:
+            f.write(''.join(line + '\n' for line in lines))
+        os.replace(tmp, target)
+        # parts of an earlier Spark write of the same output
+        for entry in os.listdir(path):
+            if entry.startswith('part-') and entry != cls.PART:
+                os.remove(os.path.join(path, entry))
+        open(os.path.join(path, '_SUCCESS'), 'a').close()
+
+    def flush(self):
+        self.queue.join()
+        if self.errors:
+            path, e = self.errors[0]
+            self.errors = []
+            raise IOError('failed to write {}: {}'.format(path, e))
+
+
+class LazyDataDict(MutableMapping):
+    """Dataset dictionary that loads an input the first time it is read.
+
+    Datasets handed to defer() are narrowed and cached when first read
+    rather than straight away, so only the inputs a run actually touches are
+    ever scanned.
+    """
+
+    def __init__(self, data_io, input_format='dataframe', cache=False):
+        self.data_io = data_io
+        self.input_format = input_format
+        self.cache = cache
+        self.loaded = {}
+        self.deferred = {}
+        self.lock = threading.RLock()
+
+    def __getitem__(self, name):
+        with self.lock:
+            if name not in self.loaded:
+                if name not in self.data_io.path_dict:
+                    raise KeyError(name)
+                self.loaded[name] = self.data_io.load_one(
+                    name, self.input_format, cache=self.cache)
+            if name in self.deferred:
+                columns = self.deferred.pop(name)
+                self.loaded[name] = self.data_io.narrow(
+                    self.loaded[name], columns).cache()
+            return self.loaded[name]
+
+    def __setitem__(self, name, data):
+        with self.lock:
+            self.deferred.pop(name, None)
+            self.loaded[name] = data
+
+    def __delitem__(self, name):
+        self.deferred.pop(name, None)
+        del self.loaded[name]
+
+    def __iter__(self):
+        return iter(self.data_io.path_dict)
+
+    def __len__(self):
+        return len(self.data_io.path_dict)
+
+    def is_loaded(self, name):
+        return name in self.loaded
+
+    def defer(self, name, columns=None):
+        """Narrow and cache name on first access (now, if already loaded)."""
+        self.deferred[name] = columns
+        if name in self.loaded:
+            self[name]
+
+
 class PA2Data(object):
     review_schema = T.StructType([
         T.StructField('reviewerID', T.StringType(), False),
@@ -256,38 +2398,82 @@ class PA2Data(object):
         'product': product_schema,
         'product_processed': product_processed_schema
     }
+    asin_dictionary_schema = T.StructType([
+        T.StructField('asin', T.StringType(), False),
+        T.StructField('asin_id', T.IntegerType(), False)
+    ])
     metadata_schema = {
         'salesRank': salesRank_schema,
         'categories': categories_schema,
         'related': related_schema
     }
+    # results up to this many rows are saved without Spark
+    LOCAL_ROWS = 10000
 
     def __init__(self,
                  spark,
                  path_dict,
                  output_root,
                  deploy,
-                 input_format='dataframe'
+                 input_format='dataframe',
+                 conversion_root=None,
+                 encode_asin=False,
+                 review_state_root=None,
+                 buckets=None,
+                 materialize_root=None
                  ):
         self.spark = spark
         self.path_dict = path_dict
         self.output_root = output_root
         self.deploy = deploy
         self.input_format = input_format
+        self.conversion_root = conversion_root
+        self.encode_asin = encode_asin
+        # bucketed tables live next to the Parquet copies
+        self.buckets = buckets if conversion_root else None
+        self.materialize_root = materialize_root
+        for root in [conversion_root, materialize_root, review_state_root]:
+            if root:
+                check_shared_root(spark, root)
+        self.review_store = None
+        if review_state_root:
+            self.review_store = ReviewRollupStore(spark, review_state_root)
+        self.derived_data = {}
+        # derived tables cached in memory for want of a conversion_root
+        self.derived_cached = set()
+        self.writer = None
+        self.join_planner = JoinPlanner()
+        self.join_log = []
+        # the task a thread is running, for the join log
+        self.context = threading.local()
 
     def load(self, name, path, infer_schema=False):
         if name in ['ml_features_train', 'ml_features_test']:
-            data = self.spark.read.parquet(path)
-        else:
-            schema = self.schema[name] if not infer_schema else None
-            data = self.spark.read.csv(
-                path,
-                schema=schema,
-                escape='"',
-                quote='"',
-                inferSchema=infer_schema,
-                header=True
-            )
+            return self.spark.read.parquet(path)
+        converted = None
+        # with a review store the review input grows daily and is only read
+        # file by file, so converting it whole would defeat the point
+        incremental = name == 'review' and self.review_store is not None
+        if self.conversion_root and not infer_schema and not incremental:
+            converted = self.converted_path(name, path)
+        if converted and self.is_bucketed(name):
+            return self.bucketed_table(
+                name + '_bucketed', converted,
+                lambda: self.read_csv(name, path))
+        if converted and os.path.exists(os.path.join(converted, '_SUCCESS')):
+            return self.spark.read.parquet(uri(converted))
+        data = self.read_csv(name, path, infer_schema)
+        if converted:
+            self.store_parquet(name, data, converted)
+            data = self.spark.read.parquet(uri(converted))
+        return data
+
+    def is_bucketed(self, name):
+        return bool(self.buckets) and name in BUCKETED_INPUTS
+
+    def read_csv(self, name, path, infer_schema=False):
+        data = read_csv(self.spark, path,
+                        self.schema[name] if not infer_schema else None)
         if name == 'product':
             for column, column_schema in self.metadata_schema.items():
                 if column in data.columns:
@@ -295,25 +2481,308 @@ class PA2Data(object):
                         F.col(column), column_schema))
         return data
 
-    def load_all(self, input_format='dataframe', no_cache=False):
+    def converted_path(self, name, path):
+        """Location of the Parquet copy of a CSV input, keyed on the source
+        path, size and mtime (and the schema it is parsed with), or None if
+        the source cannot be fingerprinted."""
+        fingerprint = path_fingerprint(path)
+        if fingerprint is None:
+            return None
+        key = dict(fingerprint, schema=self.schema[name].json())
+        if self.is_bucketed(name):
+            key['buckets'] = self.buckets
+            name = name + '_bucketed'
+        return os.path.join(
+            local_path(self.conversion_root),
+            '{}-{}.parquet'.format(name, digest(key)))
+
+    def store_parquet(self, name, data, path):
+        print ("Writing {} to parquet ...".format(name), end='')  # noqa
+        data.write.mode('overwrite').parquet(uri(path))
+        self.remove_stale(name, path)
+        print ("Done")
+
+    @staticmethod
+    def remove_stale(name, path):
+        """Drop copies of name made from earlier versions of the inputs."""
+        root = os.path.dirname(path)
+        for entry in os.listdir(root):
+            stale = os.path.join(root, entry)
+            if entry.startswith(name + '-') and entry.endswith('.parquet') \
+                    and stale != path:
+                shutil.rmtree(stale, ignore_errors=True)
+
+    def bucketed_table(self, name, path, build, column='asin'):
+        """Table stored at path in self.buckets buckets, bucketed and sorted
+        on column, so that joins and aggregations on column between such
+        tables need no shuffle or sort. Written from build() the first time;
+        later sessions register the existing files with the catalog."""
+        table = os.path.basename(path)[:-len('.parquet')].replace('-', '_')
+        if table in [t.name for t in self.spark.catalog.listTables()]:
+            return self.spark.table(table)
+        if os.path.exists(os.path.join(path, '_SUCCESS')):
+            schema = self.spark.read.parquet(uri(path)).schema
+            columns = ', '.join('`{}` {}'.format(
+                field.name, field.dataType.simpleString()) for field in schema)
+            self.spark.sql(
+                "CREATE TABLE {} ({}) USING parquet "
+                "CLUSTERED BY (`{}`) SORTED BY (`{}`) INTO {} BUCKETS "
+                "LOCATION '{}'".format(table, columns, column, column,
+                                       self.buckets, uri(path)))
+        else:
+            print ("Writing {} to bucketed parquet ...".format(name), end='')  # noqa
+            build().write.mode('overwrite') \
+                .bucketBy(self.buckets, column).sortBy(column) \
+                .option('path', uri(path)).saveAsTable(table)
+            self.remove_stale(name, path)
+            print ("Done")
+        return self.spark.table(table)
+
+    def derived_path(self, name, inputs, root=None, extra=None):
+        """Location under root (the conversion_root by default) of a table
+        derived from the given inputs, keyed on their fingerprints (and on
+        extra, if given), or None if it cannot be stored."""
+        root = root or self.conversion_root
+        if not root:
+            return None
+        key = {} if extra is None else {'': extra}
+        for input_name in inputs:
+            if input_name not in self.path_dict:
+                return None
+            key[input_name] = path_fingerprint(self.path_dict[input_name])
+            if key[input_name] is None:
+                return None
+        return os.path.join(local_path(root),
+                            '{}-{}.parquet'.format(name, digest(key)))
+
+    def derived(self, name, inputs, build, bucket_by=None):
+        """Table name built by build() from inputs: read from its Parquet copy
+        when one exists for the current inputs and source of build and of
+        the helpers it calls (see source_digest), otherwise built and stored
+        (or cached in memory until release_derived without a
+        conversion_root). bucket_by stores it like the bucketed inputs when
+        those are enabled."""
+        if name in self.derived_data:
+            return self.derived_data[name]
+        extra = {'source': source_digest(build),
+                 'data_io': source_digest(type(self))}
+        path = self.derived_path(name, inputs, extra=extra)
+        if path and bucket_by and self.buckets:
+            key = {'path': path, 'buckets': self.buckets}
+            path = os.path.join(os.path.dirname(path), '{}_bucketed-{}.parquet'
+                                .format(name, digest(key)))
+            data = self.bucketed_table(name + '_bucketed', path, build,
+                                       bucket_by)
+        elif path and os.path.exists(os.path.join(path, '_SUCCESS')):
+            data = self.spark.read.parquet(uri(path))
+        elif path:
+            self.store_parquet(name, build(), path)
+            data = self.spark.read.parquet(uri(path))
+        else:
+            data = build().persist(StorageLevel.MEMORY_AND_DISK)
+            self.derived_cached.add(name)
+        self.derived_data[name] = data
+        return data
+
+    def release_derived(self):
+        """Unpersist the derived tables cached in memory and forget all
+        derived tables, so the next use reads or builds them again."""
+        for name in self.derived_cached:
+            self.derived_data[name].unpersist()
+        self.derived_cached.clear()
+        self.derived_data.clear()
+
+    def materialize(self, name, build, inputs, partition_by=()):
+        """Per-row task output name, built by build() from the named inputs.
+        With a materialize_root it is stored there as Parquet, partitioned by
+        the partition_by columns, and read back by later runs until one of
+        the inputs, the source of build or of the helpers it calls (see
+        source_digest) or partition_by changes, when it is rebuilt and the
+        old copy removed. Without one this is just build()."""
+        path = None
+        if self.materialize_root:
+            extra = {'source': source_digest(build),
+                     'data_io': source_digest(type(self)),
+                     'partition_by': list(partition_by)}
+            path = self.derived_path(name, inputs, self.materialize_root,
+                                     extra)
+        if path is None:
+            return build()
+        if not os.path.exists(os.path.join(path, '_SUCCESS')):
+            print ("Materializing {} ...".format(name), end='')  # noqa
+            build().write.mode('overwrite').partitionBy(*partition_by) \
+                .parquet(uri(path))
+            self.remove_stale(name, path)
+            print ("Done")
+        return self.spark.read.parquet(uri(path))
+
+    def review_rollup(self, review_data, key='asin'):
+        """Per-key review statistics (see rollup_reviews). Built once per
+        review input and reused by later runs; with a review_state_root it
+        comes from a ReviewRollupStore that only reads review files it has
+        not seen before."""
+        if self.review_store is not None:
+            state = self.review_store.update(self.path_dict.get('review'))
+            if key == 'asin_id':
+                state = self.join(state, self.asin_dictionary(), 'asin',
+                                  'left', label='review_rollup').drop('asin')
+            return state
+        inputs = ['product', 'review'] if key == 'asin_id' else ['review']
+        # bucketed like review, so the groupBy and product join stay local
+        return self.derived('review_rollup_' + key, inputs,
+                            lambda: rollup_reviews(review_data, key),
+                            bucket_by='asin' if key == 'asin' else None)
+
+    def asin_dictionary(self):
+        """Dense int32 id for every asin of the product and review tables and
+        of the also_viewed lists."""
+        def build():
+            product = self.load('product', self.path_dict['product'])
+            review = self.load('review', self.path_dict['review'])
+            asins = product.select('asin').union(review.select('asin')).union(
+                product.select(
+                    F.explode(F.col('related')['also_viewed']).alias('asin'))
+            ).where(F.col('asin').isNotNull()).distinct()
+            ids = asins.rdd.map(lambda row: row[0]).zipWithIndex()
+            return self.spark.createDataFrame(ids, self.asin_dictionary_schema)
+        return self.derived('asin_dictionary', ['product', 'review'], build)
+
+    def encoded(self, name):
+        """review or product with asin replaced by asin_id, or the
+        related_edges table (asin_id, also_viewed_id) of also_viewed lists.
+        Null or unknown asins map to a null id."""
+        def build():
+            dictionary = self.asin_dictionary()
+            if name == 'related_edges':
+                edges = self.load('product', self.path_dict['product']).select(
+                    'asin',
+                    F.explode(F.col('related')['also_viewed']).alias('also_viewed'))
+                targets = dictionary.select(
+                    F.col('asin').alias('also_viewed'),
+                    F.col('asin_id').alias('also_viewed_id'))
+                edges = self.join(edges, dictionary, 'asin', 'left',
+                                  label='related_edges')
+                return self.join(edges, targets, 'also_viewed', 'left',
+                                 label='related_edges') \
+                    .select('asin_id', 'also_viewed_id')
+            data = self.load(name, self.path_dict[name])
+            return self.join(data, dictionary, 'asin', 'left',
+                             label=name).drop('asin')
+        return self.derived(name + '_encoded', ['product', 'review'], build)
+
+    def set_task(self, task_name):
+        """Attribute the calling thread's joins to task_name."""
+        self.context.task_name = task_name
+
+    def join(self, left, right, key, how='inner', label=None,
+             unique_left=False):
+        """Equi-join on key with the strategy JoinPlanner picks (broadcast,
+        salted or sort-merge), recorded in join_log. unique_left skips the
+        skew profile of left (see JoinPlanner.choose)."""
+        joined, strategy, details = self.join_planner.join(
+            left, right, key, how, unique_left)
+        entry = {'task_name': getattr(self.context, 'task_name', None),
+                 'label': label, 'key': key, 'how': how,
+                 'strategy': strategy, 'details': details}
+        self.join_log.append(entry)
+        print ("{} join {} on {}: {} {}".format(
+            entry['task_name'], label, key, strategy,
+            json.dumps(details, default=str)))
+        return joined
+
+    def store_join_log(self, filename='join_strategies.json'):
+        if not self.join_log:
+            return
+        os.makedirs(self.output_root, exist_ok=True)
+        with open(os.path.join(self.output_root, filename), 'w') as f:
+            json.dump(self.join_log, f, indent=1, default=str)
+
+    @staticmethod
+    def required_columns(task_names):
+        """Union of the columns the given tasks read, per input."""
+        required = {}
+        for task_name in task_names:
+            for name, columns in TASK_INPUTS[task_name].items():
+                if columns is None or required.get(name, []) is None:
+                    required[name] = None
+                else:
+                    required[name] = required.get(name, []) + [
+                        c for c in columns if c not in required.get(name, [])]
+        return required
+
+    @staticmethod
+    def narrow(data, columns):
+        """Project a DataFrame down to columns. Spark pushes the projection
+        into the scan, so the CSV parser and from_json skip the rest."""
+        if columns is None or not isinstance(data, DataFrame):
+            return data
+        return data.select(*[c for c in columns if c in data.columns])
+
+    def task_inputs(self, data_dict, task_name):
+        inputs = []
+        for name, columns in TASK_INPUTS[task_name].items():
+            if self.encode_asin and self.input_format == 'dataframe' and \
+                    task_name in ASIN_ENCODED_TASKS and \
+                    name in ['review', 'product']:
+                data = self.encoded(name)
+                columns = columns and [
+                    'asin_id' if c == 'asin' else c for c in columns]
+            else:
+                data = data_dict[name]
+            inputs.append(self.narrow(data, columns))
+        return inputs
+
+    def load_one(self, name, input_format='dataframe', cache=False):
+        data = self.load(name, self.path_dict[name])
+        if input_format == 'rdd':
+            data = data.rdd
+        elif input_format == 'koalas':
+            data = data.to_koalas()
+        if self.deploy and cache:
+            data = data.cache()
+        return data
+
+    def load_all(self, input_format='dataframe', no_cache=False, lazy=False):
         self.input_format = input_format
+        if lazy:
+            data_dict = LazyDataDict(self, input_format, cache=not no_cache)
+            return data_dict, dict.fromkeys(self.path_dict)
         print ("Loading datasets ...", end='')  # noqa
         data_dict = {}
         count_dict = {}
-        for name, path in self.path_dict.items():
-
-            data = self.load(name, path)
-            if input_format == 'rdd':
-                data = data.rdd
-            elif input_format == 'koalas':
-                data = data.to_koalas()
-            if self.deploy and not no_cache:
-                data = data.cache()
+        for name in self.path_dict:
+            data = self.load_one(name, input_format, cache=not no_cache)
             data_dict[name] = data
             count_dict[name] = data.count() if not no_cache else None
         print ("Done")
         return data_dict, count_dict
 
+    def row_count(self, name):
+        """Row count of an input read from Parquet footers, without running
+        a Spark job. None if the input has no Parquet copy."""
+        path = self.path_dict[name]
+        if name not in ['ml_features_train', 'ml_features_test']:
+            if not self.conversion_root:
+                return None
+            path = self.converted_path(name, path)
+            if path is None or \
+                    not os.path.exists(os.path.join(path, '_SUCCESS')):
+                return None
+        path = local_path(path)
+        if '://' in path or not os.path.exists(path):
+            return None
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            return None
+        if os.path.isdir(path):
+            files = [os.path.join(root, f)
+                     for root, _, fs in os.walk(path)
+                     for f in fs if f.endswith('.parquet')]
+        else:
+            files = [path]
+        return sum(pq.ParquetFile(f).metadata.num_rows for f in files)
+
     def cache_switch(self, data_dict, part):
         count_dict = {}
         if self.input_format == 'koalas':
@@ -322,35 +2791,67 @@ class PA2Data(object):
             part_1_data = ['product', 'review', 'product_processed']
             part_2_data = ['ml_features_train', 'ml_features_test']
             if part == 'part_1':
-                data_dict, count_dict = self.switch(data_dict, part_1_data, part_2_data)
+                columns = self.required_columns(TASK_NAMES[:6])
+                data_dict, count_dict = self.switch(
+                    data_dict, part_1_data, part_2_data, columns)
             elif part == 'part_2':
-                data_dict, count_dict = self.switch(data_dict, part_2_data, part_1_data)
+                columns = self.required_columns(TASK_NAMES[6:])
+                data_dict, count_dict = self.switch(
+                    data_dict, part_2_data, part_1_data, columns)
             else:
                 raise ValueError
         return data_dict, count_dict
 
-    def switch(self, data_dict, to_persist, to_unpersist):
+    def switch(self, data_dict, to_persist, to_unpersist, columns=None):
         count_dict = {}
+        columns = columns or {}
+        lazy = isinstance(data_dict, LazyDataDict)
         for name in to_unpersist:
+            if lazy and not data_dict.is_loaded(name):
+                continue
             try:
                 data_dict[name].unpersist()
             except Exception as e:
                 pass
         for name in to_persist:
-            data_dict[name] = data_dict[name].cache()
+            if lazy:
+                data_dict.defer(name, columns.get(name))
+                count_dict[name] = self.row_count(name)
+                continue
+            # cache only the columns the part's tasks read
+            data_dict[name] = self.narrow(
+                data_dict[name], columns.get(name)).cache()
             count_dict[name] = data_dict[name].count()
         return data_dict, count_dict
 
     def save(self, res, task_name, filename=None):
+        """Write res as output_root/<filename>.json. Results of up to
+        LOCAL_ROWS rows are written by the driver in the background (see
+        flush); larger ones, or ones json_rows cannot render, by Spark."""
         if task_name in TASK_NAMES or task_name in ['task_0', 'summary']:
             if not filename:
                 filename = task_name
+            output_path = os.path.join(self.output_root, filename + EXT)
+            lines = None
+            if isinstance(res, Mapping) or len(res) <= self.LOCAL_ROWS:
+                try:
+                    lines = json_rows(res)
+                except TypeError:
+                    pass
+            if lines is not None and '://' not in output_path:
+                if self.writer is None:
+                    self.writer = ResultWriter()
+                self.writer.submit(output_path, lines)
+                return
             if isinstance(res, Mapping):
                 df = self.spark.createDataFrame([res])
             else:
                 df = self.spark.createDataFrame(res)
-            output_path = 'file://' + os.path.join(
-                self.output_root, filename + EXT)
-            df.coalesce(1).write.mode('overwrite').json(output_path)
+            df.coalesce(1).write.mode('overwrite').json(uri(output_path))
         else:
             raise ValueError
+
+    def flush(self):
+        """Wait until every saved result is on disk."""
+        if self.writer is not None:
+            self.writer.flush()